@@ -1,258 +1,516 @@
-import pika
-import json
-import threading
 import tkinter as tk
 import tkinter.ttk as ttk
-from PIL import Image, ImageTk
+import tkinter.font as tkfont
 import os
-import requests
-from requests.exceptions import ConnectTimeout, ConnectionError
-import socket
-from dotenv import load_dotenv
 import atexit
+import queue
+import signal
+import bisect
+import collections
+import functools
+import json
+import sys
+import threading
+import time
+import traceback
+
+from notifier_core import NotifierCore, NotificationSink, io_executor
+import notifier_metrics
+import notifier_profiling
+
+# Notification windows built at startup and kept withdrawn, ready to be filled and shown
+NOTIFICATION_POOL_SIZE = int(os.getenv('NOTIFICATION_POOL_SIZE', '1'))
+# How often the Tk thread drains results posted by background threads
+UI_POLL_MS = 50
+# Event-loop lag watchdog: a root.after probe every UI_WATCHDOG_PROBE_MS (0 disables it); when the mainloop misses
+# it by more than UI_STALL_THRESHOLD_MS the Tk thread's stack is captured, and each stall is logged with the callback
+# that blocked and for how long, also as a JSON line to UI_STALL_LOG_PATH if set.
+UI_WATCHDOG_PROBE_MS = int(os.getenv('UI_WATCHDOG_PROBE_MS', '100'))
+UI_STALL_THRESHOLD_MS = int(os.getenv('UI_STALL_THRESHOLD_MS', '500'))
+UI_STALL_LOG_PATH = os.getenv('UI_STALL_LOG_PATH')
+# Notifications longer than this are shown in a scrollable view that lays out only the lines on screen
+LARGE_CONTENT_CHARS = int(os.getenv('LARGE_CONTENT_CHARS', '2000'))
+# Pending notifications are shown highest priority first; one at or above URGENT_PRIORITY also takes the place of a
+# lower-priority notification already on screen, which goes back to the front of the backlog
+URGENT_PRIORITY = int(os.getenv('URGENT_PRIORITY', '5'))
+# Attachments shown in the client, and those handed to their default application; the extension comes from the
+# message, so anything else (programs, scripts, shortcuts) is listed but can't be opened
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp')
+DOCUMENT_EXTENSIONS = ('.pdf', '.txt', '.csv', '.rtf', '.doc', '.docx', '.xls', '.xlsx', '.ppt', '.pptx', '.odt',
+                       '.ods', '.odp')
+
+# Pairing, consuming and status publishing (see notifier_core.py); created in main
+notifier = None
+
+# (callback, args) pairs to run on the Tk thread, drained by process_ui_queue. A SimpleQueue, because signal
+# handlers (SIGTERM, the profiling toggle) post to it and its put is reentrant, unlike Queue's
+ui_queue = queue.SimpleQueue()
+
+# Notifications waiting for acknowledgement, highest priority first, shown one at a time in a single modal (Tk
+# thread only)
+pending_notifications = collections.deque()
+# Widgets of the open notification modal, or None while no modal is shown
+notification_view = None
+# Prebuilt, withdrawn notification windows waiting to be reused
+window_pool = []
+
+# Gradient and logo rendered once and shared by every notification window; rebuilt only when the screen size changes
+window_assets = {'screen_size': None, 'gradient': None, 'logo': None}
+# Decoded Logo.png, loaded at most once per process (False once loading has failed)
+logo_source = None
+
+# Monotonic time the Tk mainloop last ran the watchdog probe, and the most recent stalls it caught
+last_probe_at = None
+ui_stalls = collections.deque(maxlen=50)
+
+# Tk root window and its connection status label; created in main so importing this module needs no display
+root = None
+status_label = None
+
+
+def build_root():
+    global root, status_label
+    root = tk.Tk()
+    root.title("Connection Status")
+    root.protocol("WM_DELETE_WINDOW", lambda: None)  # Disable window close button
+    # Logoff or reboot; on Windows Tk raises this for WM_QUERYENDSESSION
+    root.protocol("WM_SAVE_YOURSELF", quit_app)
+    status_label = tk.Label(root, text="Initializing...", font=("Helvetica", 12))
+    status_label.pack()
+
+
+# Function to schedule a callback on the Tk thread; safe to call from any thread
+def run_on_ui(callback, *args):
+    ui_queue.put((callback, args))
+
+
+# Function to run a blocking call on the I/O executor, handing its result to on_done on the Tk thread
+def run_in_background(func, *args, on_done=None):
+    def deliver(future):
+        try:
+            result = future.result()
+        except Exception as e:
+            print(f"Background task {func.__name__} failed: {e}")
+            return
+        if on_done is not None:
+            run_on_ui(on_done, result)
+
+    future = io_executor.submit(func, *args)
+    future.add_done_callback(deliver)
+    return future
+
+
+def process_ui_queue():
+    """ Runs callbacks posted by background threads, then reschedules itself. """
+    while True:
+        try:
+            callback, args = ui_queue.get_nowait()
+        except queue.Empty:
+            break
+        try:
+            callback(*args)
+        except Exception as e:
+            print(f"Error in UI callback {getattr(callback, '__name__', callback)}: {e}")
+    if not notifier.stop_event.is_set():
+        root.after(UI_POLL_MS, process_ui_queue)
+
+
+def watchdog_probe():
+    """ Runs on the Tk thread every UI_WATCHDOG_PROBE_MS; how late it runs is the mainloop lag. """
+    global last_probe_at
+    now = time.monotonic()
+    if last_probe_at is not None:
+        lag = now - last_probe_at - UI_WATCHDOG_PROBE_MS / 1000
+        notifier_metrics.observe('notifier_ui_lag_seconds', max(lag, 0))
+    last_probe_at = now
+    if not notifier.stop_event.is_set():
+        root.after(UI_WATCHDOG_PROBE_MS, watchdog_probe)
+
+
+def blocking_callback(frame):
+    # From the outermost frame in, the first one that is neither module level nor tkinter itself is the callback
+    # Tk invoked; for callbacks posted through ui_queue, report the one process_ui_queue is running instead
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    tkinter_dir = os.path.dirname(tk.__file__)
+    for frame in reversed(frames):
+        code = frame.f_code
+        if code is process_ui_queue.__code__:
+            callback = frame.f_locals.get('callback')
+            return getattr(callback, '__name__', repr(callback))
+        if code.co_name != '<module>' and not code.co_filename.startswith(tkinter_dir):
+            return code.co_name
+    return None
+
+
+def start_ui_watchdog():
+    global last_probe_at
+    # Count from now, so a callback that blocks before the first probe runs is caught too
+    last_probe_at = time.monotonic()
+    root.after(UI_WATCHDOG_PROBE_MS, watchdog_probe)
+    threading.Thread(target=watch_ui_thread, args=(threading.get_ident(),), name='notifier-ui-watchdog',
+                     daemon=True).start()
+
+
+def watch_ui_thread(ui_thread_id):
+    """ Thread target: captures the Tk thread's stack while the mainloop is stuck and records each stall. """
+    interval = UI_WATCHDOG_PROBE_MS / 1000
+    threshold = UI_STALL_THRESHOLD_MS / 1000
+    stall = None
+    while not notifier.stop_event.wait(interval):
+        since = last_probe_at
+        if since is None:
+            continue
+        if stall is not None and stall['since'] != since:
+            # The probe ran again, so the stall is over
+            stall['blocked_ms'] = round((since - stall['since'] - interval) * 1000)
+            record_ui_stall(stall)
+            stall = None
+        elif stall is None and time.monotonic() - since - interval > threshold:
+            # Still blocked: the stack shows what the Tk thread is doing right now
+            frame = sys._current_frames().get(ui_thread_id)
+            stall = {
+                'since': since,
+                'at': time.time(),
+                'callback': blocking_callback(frame) if frame is not None else None,
+                'stack': ''.join(traceback.format_stack(frame)) if frame is not None else '',
+            }
+
+
+def record_ui_stall(stall):
+    del stall['since']
+    ui_stalls.append(stall)
+    notifier_metrics.inc('notifier_ui_stalls_total')
+    print(f"UI thread blocked for {stall['blocked_ms']} ms in {stall['callback']}:\n{stall['stack']}")
+    if UI_STALL_LOG_PATH:
+        try:
+            with open(UI_STALL_LOG_PATH, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(stall) + '\n')
+        except OSError as e:
+            print(f"Error writing UI stall log: {e}")
+
 
-# Global stop event to manage all threads and loops
-stop_event = threading.Event()
-
-# Load environment variables from a standard .env file if present
-load_dotenv()
-API_BASE_URL = os.getenv('API_BASE_URL', 'http://localhost:8000')
-RABBITMQ_HOST = os.getenv('RABBITMQ_HOST', 'localhost')
-RABBITMQ_PORT = int(os.getenv('RABBITMQ_PORT', 5672))
-RABBITMQ_USERNAME = os.getenv('RABBITMQ_USERNAME', 'guest')
-RABBITMQ_PASSWORD = os.getenv('RABBITMQ_PASSWORD', 'guest')
-TOKEN_FILE_PATH = os.getenv('TOKEN_FILE_PATH', 'app/terminal_token.json')
-# Heartbeat interval in minutes (default 3). Convert to milliseconds for Tkinter's after().
-HEARTBEAT_MINS = int(os.getenv('HEARTBEAT_MINS', '3'))
-HEARTBEAT_MS = HEARTBEAT_MINS * 60 * 1000
-
-# Global state
-token = None
-
-# Initialize Tkinter
-root = tk.Tk()
-root.title("Connection Status")
-root.protocol("WM_DELETE_WINDOW", lambda: None)  # Disable window close button
-status_label = tk.Label(root, text="Initializing...", font=("Helvetica", 12))
-status_label.pack()
-
-
-# Function to load the token from a local file if it exists
-def load_local_token():
-    global token
-    if os.path.exists(TOKEN_FILE_PATH):
-        with open(TOKEN_FILE_PATH, 'r') as f:
-            data = json.load(f)
-            token = data.get('token')
-            print(f"Loaded token from file: {token}")
-            return True
-    return False
-
-# Function to save the token to a local file
-def save_local_token(token):
-    with open(TOKEN_FILE_PATH, 'w') as f:
-        json.dump({'token': token}, f)
-    print(f"Token saved locally: {token}")
-
-# Function to update the status in the Tkinter UI
-def update_status(new_status):
+def set_status_text(new_status):
     status_label.config(text=f"Status: {new_status}")
-    root.update_idletasks()
-    
-def send_sign_out():
-    hostname = socket.gethostname()
-    try:
-        response = requests.post(f'{API_BASE_URL}/terminal_sign_out/', data={'hostname': hostname}, timeout=10)
-        print("Sent sign out signal.")
-    except Exception as e:
-        print(f"Error sending sign out: {e}")
 
-atexit.register(send_sign_out)
-    
-def send_heartbeat():
-    """ Periodically sends a heartbeat signal. """
-    if stop_event.is_set():
-        return
-    hostname = socket.gethostname()
-    try:
-        response = requests.post(f'{API_BASE_URL}/terminal_heartbeat/', data={'hostname': hostname}, timeout=10)
-        if response.status_code == 200:
-            print("Heartbeat sent successfully.")
-        else:
-            print(f"Heartbeat failed: {response.content}")
-    except Exception as e:
-        print(f"Error sending heartbeat: {e}")
-    root.after(HEARTBEAT_MS, send_heartbeat)  # Schedule the next heartbeat
-
-    
-def send_status_update(notification_id, status):
-    credentials = pika.PlainCredentials(RABBITMQ_USERNAME, RABBITMQ_PASSWORD)
-    parameters = pika.ConnectionParameters(host=RABBITMQ_HOST, port=RABBITMQ_PORT, credentials=credentials)
-
-    connection = pika.BlockingConnection(parameters)
-    channel = connection.channel()
-    exchange_name = 'notifications_responses'
-    channel.exchange_declare(exchange=exchange_name, exchange_type='direct', durable=True)
-
-    message = {
-        'notification_id': notification_id,
-        'status': status
-    }
 
-    channel.basic_publish(
-        exchange=exchange_name,
-        routing_key='django_server',
-        body=json.dumps(message),
-        properties=pika.BasicProperties(delivery_mode=2)
-    )
-    connection.close()
+class TkSink(NotificationSink):
+    """ Hands notifications and status changes from the transport loop to the Tk thread. """
 
+    def notify(self, notification):
+        run_on_ui(show_notification, notification)
 
-def get_external_ip():
-    if API_BASE_URL == 'http://localhost:8000':
-        # Use localhost IP if running locally
-        return '127.0.0.1'
-    try:
-        external_ip = requests.get('https://api.ipify.org').text
-        return external_ip
-    except requests.RequestException as e:
-        print(f"Error fetching external IP: {e}")
-        return None
+    def status(self, text):
+        run_on_ui(set_status_text, text)
 
-def pair_with_server():
-    global token
-    external_ip = get_external_ip()
-    hostname = socket.gethostname()
 
-    update_status("Pairing...")
-    try:
-        response = requests.post(f'{API_BASE_URL}/pair/', data={'external_ip': external_ip, 'hostname': hostname}, timeout=10)
-        if response.status_code == 200:
-            token = response.json().get('token')
-            print(f"Successfully paired with token: {token}")
-            save_local_token(token)
-            update_status("Paired with server")
-            return True
-        else:
-            print("Pairing failed.")
-            update_status("Pairing failed.")
-            return False
-    except (ConnectTimeout, ConnectionError) as e:
-        print(f"Connection error during pairing: {e}")
-        update_status("Connection failed, retrying...")
-        return False
-    except Exception as e:
-        print(f"Unexpected error during pairing: {e}")
-        update_status("Unexpected error, retrying...")
-        return False
-
-def attempt_pairing():
-    retry_delay = 5  # Initial retry delay (seconds)
-
-    while not stop_event.is_set():
-        if pair_with_server():
-            # Start consuming messages in a separate thread
-            consumer_thread = threading.Thread(target=start_consuming, daemon=True)
-            consumer_thread.start()
-            break
-        else:
-            update_status(f"Pairing failed, retrying in {retry_delay} seconds...")
-            if stop_event.wait(timeout=retry_delay):  # Wait with timeout for retry
-                break  # If stop_event is set, exit the loop
-            retry_delay = min(retry_delay * 2, 60)  # Increase delay up to max of 60 seconds
-
-def start_consuming():
-    global token
-    while not stop_event.is_set():
-        try:
-            credentials = pika.PlainCredentials(RABBITMQ_USERNAME, RABBITMQ_PASSWORD)
-            parameters = pika.ConnectionParameters(
-                host=RABBITMQ_HOST,
-                port=RABBITMQ_PORT,
-                credentials=credentials,
-            )
-            
-            connection = pika.BlockingConnection(parameters)
-            channel = connection.channel()
-            exchange_name = 'notifications'
-            channel.exchange_declare(exchange=exchange_name, exchange_type='direct', durable=True)
-            
-            queue_name = f'queue_{token}'
-            channel.queue_declare(queue=queue_name, durable=True)
-            channel.queue_bind(exchange=exchange_name, queue=queue_name, routing_key=token)
-            
-            print(f"Listening for notifications on queue {queue_name} with routing key {token}...")
-            update_status("Connected and Listening")
-            channel.basic_consume(queue=queue_name, on_message_callback=on_notification_received, auto_ack=True)
-    
-            # Start consuming messages
-            channel.start_consuming()
-        except pika.exceptions.ChannelClosedByBroker as e:
-            print(f"Channel closed by broker: {e}")
-            update_status("Token invalid or expired. Re-pairing...")
-            if pair_with_server():
-                save_local_token(token)
-                continue  # Restart consuming with new token
-            else:
-                update_status("Re-pairing failed, retrying...")
-                if stop_event.wait(timeout=5):  # Wait 5 seconds or until stop_event is set
-                    break
-        except pika.exceptions.AMQPConnectionError as e:
-            print(f"RabbitMQ connection error: {e}")
-            update_status("Connection lost, reconnecting...")
-            if stop_event.wait(timeout=5):  # Retry with a 5-second delay
-                break
-        except Exception as e:
-            print(f"Unexpected error in start_consuming: {e}")
-            update_status("Unexpected error, reconnecting...")
-            if stop_event.wait(timeout=5):  # Retry with a 5-second delay
-                break
-            
-def draw_gradient(canvas, width, height):
+def render_gradient(width, height):
+    # PIL is imported on first use, after the status window is up
+    from PIL import Image
     gradient_steps = 100
+    # One pixel per gradient step, stretched to the screen; NEAREST keeps the same bands as before
+    column = Image.new('RGB', (1, gradient_steps))
     for i in range(gradient_steps):
         r = 255
         g = 255 - int(5 * (i / gradient_steps))
         b = 255 - int(10 * (i / gradient_steps))
-        color = f'#{r:02x}{g:02x}{b:02x}'
-        canvas.create_rectangle(0, i * height // gradient_steps, width, (i + 1) * height // gradient_steps, fill=color, outline=color)
+        column.putpixel((0, i), (r, g, b))
+    return column.resize((width, height), Image.NEAREST)
+
+
+def load_logo_source():
+    global logo_source
+    if logo_source is None:
+        try:
+            from PIL import Image
+            image_path = os.path.join(os.getcwd(), 'Logo.png')
+            with Image.open(image_path) as image:
+                logo_source = image.copy()
+        except Exception:
+            # If image is missing or cannot be loaded, skip silently
+            logo_source = False
+    return logo_source
+
+
+def get_window_assets():
+    """ Returns the cached gradient/logo images, re-rendering them only if the screen geometry changed. """
+    screen_size = (root.winfo_screenwidth(), root.winfo_screenheight())
+    if window_assets['screen_size'] != screen_size:
+        from PIL import ImageTk
+        width, height = screen_size
+        window_assets['gradient'] = ImageTk.PhotoImage(render_gradient(width, height), master=root)
+        logo = load_logo_source()
+        if logo:
+            logo = logo.copy()
+            logo.thumbnail((width // 4, height // 4))  # Only ever scales down
+            window_assets['logo'] = ImageTk.PhotoImage(logo, master=root)
+        else:
+            window_assets['logo'] = None
+        window_assets['screen_size'] = screen_size
+    return window_assets
+
 
+@notifier_profiling.span('draw_gradient')
+def draw_gradient(canvas):
+    canvas.create_image(0, 0, image=get_window_assets()['gradient'], anchor="nw")
+
+
+@notifier_profiling.span('load_and_display_image')
 def load_and_display_image(gradient_canvas):
-    global tk_image
-    try:
-        image_path = os.path.join(os.getcwd(), 'Logo.png')
-        image = Image.open(image_path)
-        tk_image = ImageTk.PhotoImage(image)  # Store in global variable to prevent GC
-        logo_label = tk.Label(gradient_canvas, image=tk_image, bg="white")
-        logo_label.image = tk_image  # Keep reference
-        logo_label.place(x=20, y=20, anchor="nw")
-    except Exception:
-        # If image is missing or cannot be loaded, skip silently
-        pass
-
-def on_notification_received(ch, method, properties, body):
-    message = json.loads(body)
-    notification_id = message.get('notification_id')
-    sender_user = message.get('sender_user')
-    content = message.get('notification_content')
-    
-    # Send 'delivered' status back to the server
-    send_status_update(notification_id, status='delivered')
-
-    # Schedule the UI update in the main thread
-    root.after(0, show_notification, notification_id, sender_user, content)
-
-def show_notification(notification_id, sender_user, content):
+    tk_image = get_window_assets()['logo']
+    if tk_image is None:
+        return
+    logo_label = tk.Label(gradient_canvas, image=tk_image, bg="white")
+    logo_label.image = tk_image  # Keep reference
+    logo_label.place(x=20, y=20, anchor="nw")
+
+
+def wrap_lines(text, position, width, limit):
+    """ Wraps text from position into at most limit lines of up to width characters, breaking at spaces where it can.
+
+    Returns the (start, end) offsets of the lines and the position to continue from.
+    """
+    lines = []
+    length = len(text)
+    while position < length and len(lines) < limit:
+        newline = text.find('\n', position, position + width + 1)
+        if newline != -1:
+            lines.append((position, newline))
+            position = newline + 1
+            continue
+        end = position + width
+        if end >= length:
+            lines.append((position, length))
+            position = length
+            break
+        space = text.rfind(' ', position, end + 1)
+        if space > position:
+            lines.append((position, space))
+            position = space + 1
+        else:
+            lines.append((position, end))
+            position = end
+    return lines, position
+
+
+class VirtualTextView:
+    """ Scrollable read-only text for long notifications.
+
+    Only line offsets are kept; the text is wrapped a chunk at a time in idle callbacks, and a fixed set of canvas
+    items, one per visible row, is refilled as it scrolls, so layout cost follows the window height rather than
+    the length of the notification.
+    """
+
+    # Lines wrapped per idle callback while the rest of the text is measured for the scrollbar
+    WRAP_CHUNK = 2000
+    PADDING = 10
+
+    def __init__(self, parent, font, bg):
+        self.frame = tk.Frame(parent, bg=bg)
+        self.scrollbar = tk.Scrollbar(self.frame, orient="vertical", command=self.yview)
+        self.scrollbar.pack(side="right", fill="y")
+        # Requests little height so the view only takes the space left over in the card
+        self.canvas = tk.Canvas(self.frame, bg=bg, height=100, highlightthickness=0)
+        self.canvas.pack(side="left", fill="both", expand=True)
+        self.font = tkfont.Font(font=font)
+        self.line_height = self.font.metrics("linespace")
+        # Lines are wrapped by character count, using a slightly generous average character width
+        sample = "Obvestilo oddelka: vzdrževanje linije 0123456789"
+        self.char_width = 1.1 * self.font.measure(sample) / len(sample)
+        self.text = ""
+        self.lines = []
+        self.wrapped_to = 0
+        self.wrap_width = None
+        self.wrap_job = None
+        self.top = 0
+        self.rows = []
+        self.canvas.bind("<Configure>", self.on_configure)
+
+    def set_text(self, text):
+        if self.wrap_job is not None:
+            self.canvas.after_cancel(self.wrap_job)
+            self.wrap_job = None
+        self.text = text
+        self.lines = []
+        self.wrapped_to = 0
+        self.top = 0
+        self.render()
+        if text:
+            self.wrap_job = self.canvas.after(1, self.wrap_in_background)
+
+    def width_in_chars(self):
+        return max(10, int((self.canvas.winfo_width() - 2 * self.PADDING) / self.char_width))
+
+    def ensure_wrapped(self, line_count):
+        while len(self.lines) < line_count and self.wrapped_to < len(self.text):
+            lines, self.wrapped_to = wrap_lines(self.text, self.wrapped_to, self.wrap_width,
+                                                line_count - len(self.lines))
+            self.lines.extend(lines)
+
+    def wrap_in_background(self):
+        self.wrap_job = None
+        self.ensure_wrapped(len(self.lines) + self.WRAP_CHUNK)
+        self.update_scrollbar()
+        if self.wrapped_to < len(self.text):
+            self.wrap_job = self.canvas.after(1, self.wrap_in_background)
+
+    def total_lines(self):
+        # Until all of the text is wrapped, extrapolate from the lines wrapped so far
+        if self.wrapped_to >= len(self.text) or not self.lines:
+            return len(self.lines)
+        return len(self.lines) + int((len(self.text) - self.wrapped_to) * len(self.lines) / self.wrapped_to)
+
+    def visible_rows(self):
+        return max(1, self.canvas.winfo_height() // self.line_height)
+
+    def render(self):
+        if self.wrap_width is None:
+            self.wrap_width = self.width_in_chars()
+        rows = self.visible_rows()
+        self.ensure_wrapped(self.top + rows + 1)
+        if self.wrapped_to >= len(self.text):
+            self.top = min(self.top, max(0, len(self.lines) - rows))
+        self.top = max(0, self.top)
+        # One more row than fits, for the partly visible line at the bottom
+        while len(self.rows) < rows + 1:
+            self.rows.append(self.canvas.create_text(self.PADDING, 0, anchor="nw", font=self.font))
+        for index, item in enumerate(self.rows):
+            line = self.top + index
+            start, end = self.lines[line] if index <= rows and line < len(self.lines) else (0, 0)
+            self.canvas.itemconfigure(item, text=self.text[start:end])
+            self.canvas.coords(item, self.PADDING, index * self.line_height)
+        self.update_scrollbar()
+
+    def update_scrollbar(self):
+        total = max(1, self.total_lines())
+        self.scrollbar.set(self.top / total, min(1.0, (self.top + self.visible_rows()) / total))
+
+    def yview(self, action, amount, unit=None):
+        if action == "moveto":
+            self.top = int(float(amount) * self.total_lines())
+        elif unit == "pages":
+            self.top += int(amount) * max(1, self.visible_rows() - 1)
+        else:
+            self.top += int(amount)
+        self.render()
+
+    def on_mousewheel(self, event):
+        if event.num == 4 or event.delta > 0:
+            self.yview("scroll", -3, "units")
+        else:
+            self.yview("scroll", 3, "units")
+
+    def on_configure(self, event):
+        width = self.width_in_chars()
+        if width != self.wrap_width:
+            # Rewrap for the new width, keeping the first visible line in place
+            anchor = self.lines[self.top][0] if self.top < len(self.lines) else 0
+            self.wrap_width = width
+            self.lines = []
+            self.wrapped_to = 0
+            while self.wrapped_to <= anchor and self.wrapped_to < len(self.text):
+                self.ensure_wrapped(len(self.lines) + self.WRAP_CHUNK)
+            self.top = max(0, bisect.bisect_right(self.lines, (anchor, len(self.text))) - 1)
+        self.render()
+
+
+@notifier_profiling.span('show_notification')
+def show_notification(notification):
+    """ Queues a notification from the core locally by priority; a burst reuses the one open modal instead of
+    stacking windows, and only the newest notification per collapse_key is kept.
+    """
+    global notification_view
+    notification = dict(notification, content=notification['content'] or '', draft='', shown_at=None)
+    position = find_collapsed(notification['collapse_key'])
+    if position is not None:
+        older = pending_notifications[position]
+        if not is_newer(notification, older):
+            drop_notification(notification, 'superseded')
+            return
+        del pending_notifications[position]
+        drop_notification(older, 'superseded')
+        if position == 0:
+            # Replaces the notification on screen in place, keeping what was typed so far
+            notification['draft'] = notification_view['reply_entry'].get()
+            pending_notifications.appendleft(notification)
+            render_current_notification()
+            return
+
+    position = schedule_notification(notification)
+    if notification_view is None:
+        notification_view = acquire_notification_window()
+        render_current_notification()
+    elif position == 0:
+        # Preempted; the notification on screen keeps what was typed so far
+        pending_notifications[1]['draft'] = notification_view['reply_entry'].get()
+        render_current_notification()
+    else:
+        update_pending_counter()
+
+
+def schedule_notification(notification):
+    """ Inserts the notification behind every pending one of equal or higher priority and returns its position.
+
+    Position 0 is the notification on screen, which only an urgent notification may take.
+    """
+    position = len(pending_notifications)
+    first = 0 if notification['priority'] >= URGENT_PRIORITY else 1
+    while position > first and pending_notifications[position - 1]['priority'] < notification['priority']:
+        position -= 1
+    pending_notifications.insert(position, notification)
+    return position
+
+
+def find_collapsed(collapse_key):
+    """ Position of the pending notification with this collapse_key (there is at most one), or None. """
+    if collapse_key is None:
+        return None
+    for position, pending in enumerate(pending_notifications):
+        if pending['collapse_key'] == collapse_key:
+            return position
+    return None
+
+
+def is_newer(notification, other):
+    # By the server's send time when both have one, otherwise the later arrival wins
+    if notification['sent_at'] is not None and other['sent_at'] is not None:
+        return notification['sent_at'] >= other['sent_at']
+    return True
+
+
+def drop_notification(notification, status):
+    """ Reports a notification that will not be shown ('expired' or 'superseded') with a compact status. """
+    print(f"Dropping {status} notification {notification['notification_id']}")
+    notifier_metrics.inc(f'notifier_{status}_dropped_total')
+    notifier.send_status_update(notification['notification_id'], status, channel=notification['channel'])
+
+
+def drop_expired_notifications():
+    now = time.time()
+    expired = [n for n in pending_notifications if n['expires_at'] is not None and n['expires_at'] <= now]
+    if not expired:
+        return
+    kept = [n for n in pending_notifications if n['expires_at'] is None or n['expires_at'] > now]
+    pending_notifications.clear()
+    pending_notifications.extend(kept)
+    for notification in expired:
+        drop_notification(notification, 'expired')
+
+
+def build_notification_window():
+    """ Builds the widget tree of a notification window; it starts withdrawn and is shown by acquire. """
     msg_window = tk.Toplevel(root)
-    msg_window.title(f"Notification from {sender_user}")
+    msg_window.withdraw()
     msg_window.attributes("-fullscreen", True)
-    msg_window.grab_set()
     msg_window.attributes("-topmost", True)
     msg_window.protocol("WM_DELETE_WINDOW", lambda: None)
 
-    gradient_canvas = tk.Canvas(msg_window, width=msg_window.winfo_screenwidth(), height=msg_window.winfo_screenheight(), highlightthickness=0)
+    gradient_canvas = tk.Canvas(msg_window, width=msg_window.winfo_screenwidth(),
+                                height=msg_window.winfo_screenheight(), highlightthickness=0)
     gradient_canvas.pack(fill="both", expand=True)
-    draw_gradient(gradient_canvas, msg_window.winfo_screenwidth(), msg_window.winfo_screenheight())
+    draw_gradient(gradient_canvas)
 
     load_and_display_image(gradient_canvas)  # Load image in main thread
 
@@ -261,109 +519,354 @@ def show_notification(notification_id, sender_user, content):
 
     shadow_offset = 5
     shadow_frame = tk.Frame(content_frame, bg="#d3d3d3")
-    shadow_frame.place(relx=0.5 + shadow_offset / msg_window.winfo_screenwidth(), rely=0.5 + shadow_offset / msg_window.winfo_screenheight(), anchor="center", relwidth=1.0, relheight=1.0)
+    shadow_frame.place(relx=0.5 + shadow_offset / msg_window.winfo_screenwidth(),
+                       rely=0.5 + shadow_offset / msg_window.winfo_screenheight(),
+                       anchor="center", relwidth=1.0, relheight=1.0)
 
     card_frame = tk.Frame(content_frame, bg="white", bd=2, relief="flat")
     card_frame.place(relx=0.5, rely=0.5, anchor="center", relwidth=1.0, relheight=1.0)
 
-    sender_label = tk.Label(card_frame, text=f"Sporočilo od: {sender_user}", font=("Helvetica", 16, "bold"), bg="white")
+    sender_label = tk.Label(card_frame, font=("Helvetica", 16, "bold"), bg="white")
     sender_label.pack(pady=10)
 
     server_label = tk.Label(card_frame, text="LTH Obvestilo (ecotech.utlth-ol.si)", font=("Helvetica", 12), bg="white")
     server_label.pack(pady=5)
     server_label.bind("<Button-1>", lambda e: os.system("start http://ecotech.utlth-ol.si:8010/"))
 
-    link_label = tk.Label(card_frame, text="Obdelava Ljubljana\nVodja Oddelka: Primož Šušteršič\nLTH Python Aplikacije", font=("Helvetica", 12), fg="blue", bg="white", cursor="hand2")
+    link_label = tk.Label(card_frame, text="Obdelava Ljubljana\nVodja Oddelka: Primož Šušteršič\nLTH Python Aplikacije",
+                          font=("Helvetica", 12), fg="blue", bg="white", cursor="hand2")
     link_label.pack(pady=5)
     separator = ttk.Separator(card_frame, orient='horizontal')
     separator.pack(fill='x', pady=10)
 
-    content_text = tk.Label(card_frame, text=content, wraplength=800, font=("Helvetica", 14), bg="white")
-    content_text.pack(pady=10)
-    
+    # Short content goes in the label; content over LARGE_CONTENT_CHARS in the scrollable view instead
+    content_holder = tk.Frame(card_frame, bg="white")
+    content_holder.pack(pady=10)
+    content_text = tk.Label(content_holder, wraplength=800, font=("Helvetica", 14), bg="white")
+    content_text.pack()
+    content_view = VirtualTextView(content_holder, ("Helvetica", 14), "white")
+    for sequence in ("<MouseWheel>", "<Button-4>", "<Button-5>"):
+        msg_window.bind(sequence, content_view.on_mousewheel)
+
+    # One button per attachment; nothing is downloaded until it is clicked
+    attachments_frame = tk.Frame(card_frame, bg="white")
+    attachments_frame.pack()
+
     separator = ttk.Separator(card_frame, orient='horizontal')
     separator.pack(fill='x', pady=10)
 
     reply_card = tk.Frame(card_frame, bg="#e0f7fa", bd=0)
     reply_card.pack(pady=20, padx=20, fill="x")
-    
+
     reply_label = tk.Label(reply_card, text="Odgovor (neobvezno)", bg="#e0f7fa", font=("Helvetica", 14))
     reply_label.pack(pady=10)
 
     entry_shadow = tk.Frame(reply_card, bg="#d3d3d3")
     entry_shadow.pack(pady=(0, 10))
-    entry_frame = tk.Frame(entry_shadow, bg="white", highlightbackground="red", highlightcolor="red", highlightthickness=2)
+    entry_frame = tk.Frame(entry_shadow, bg="white", highlightbackground="red", highlightcolor="red",
+                           highlightthickness=2)
     entry_frame.pack(padx=5, pady=5)
 
     reply_entry = tk.Entry(entry_frame, width=80, font=("Helvetica", 12), bd=0)
     reply_entry.pack(padx=10, pady=10)
 
-    def acknowledge_message():
-        # user_response = reply_entry.get() or "Acknowledged"
-        # send_response(notification_id, user_response)
-        user_response = reply_entry.get()
-        if user_response.strip():
-            status = 'replied'
-        else:
-            status = 'read'
-            user_response = None  # or set to empty string
-            
-        send_response(notification_id, user_response, status)
-        msg_window.destroy()
-
     button_shadow = tk.Frame(card_frame, bg="#d3d3d3")
     button_shadow.pack(pady=20)
 
-    acknowledge_button = tk.Button(button_shadow, text="Sem seznanjen", command=acknowledge_message, font=("Helvetica", 22), bg="#2196F3", fg="white", bd=0, activebackground="#1e88e5", padx=20, pady=10)
+    acknowledge_button = tk.Button(button_shadow, text="Sem seznanjen", command=acknowledge_message,
+                                   font=("Helvetica", 22), bg="#2196F3", fg="white", bd=0,
+                                   activebackground="#1e88e5", padx=20, pady=10)
     acknowledge_button.pack()
 
+    # Backlog navigation: how many notifications are still waiting, and a way to look at the next one first
+    pending_label = tk.Label(card_frame, font=("Helvetica", 12), fg="#555555", bg="white")
+    pending_label.pack(pady=5)
+    next_button = tk.Button(card_frame, text="Naslednje obvestilo", command=show_next_notification,
+                            font=("Helvetica", 12), bg="white", bd=1, padx=10)
+    next_button.pack(pady=5)
+
+    return {
+        'window': msg_window,
+        'screen_size': get_window_assets()['screen_size'],
+        'sender_label': sender_label,
+        'content_holder': content_holder,
+        'content_text': content_text,
+        'content_view': content_view,
+        'attachments_frame': attachments_frame,
+        'reply_entry': reply_entry,
+        'pending_label': pending_label,
+        'next_button': next_button,
+    }
+
 
-def send_response(notification_id, user_response, status):
-    credentials = pika.PlainCredentials(RABBITMQ_USERNAME, RABBITMQ_PASSWORD)
-    parameters = pika.ConnectionParameters(host=RABBITMQ_HOST, port=RABBITMQ_PORT, credentials=credentials)
+def prebuild_notification_windows():
+    while len(window_pool) < NOTIFICATION_POOL_SIZE:
+        window_pool.append(build_notification_window())
 
-    connection = pika.BlockingConnection(parameters)
-    channel = connection.channel()
-    exchange_name = 'notifications_responses'
-    channel.exchange_declare(exchange=exchange_name, exchange_type='direct', durable=True)
 
-    message = {
-        'notification_id': notification_id,
-        'user_response': user_response,
-        'status': status
-    }
+def warm_up_notification_windows():
+    # Render the shared window assets and warm the window pool so the first notification doesn't pay for it
+    get_window_assets()
+    prebuild_notification_windows()
 
-    channel.basic_publish(
-        exchange=exchange_name,
-        routing_key='django_server',
-        body=json.dumps(message),
-        properties=pika.BasicProperties(delivery_mode=2)
-    )
-    connection.close()
 
-if __name__ == '__main__':
+def acquire_notification_window():
+    """ Takes a warm window from the pool (building one if it is empty) and shows it. """
+    screen_size = get_window_assets()['screen_size']
+    view = None
+    while window_pool:
+        view = window_pool.pop()
+        if view['screen_size'] == screen_size:
+            break
+        # Built for another screen geometry; the layout and gradient no longer fit
+        view['window'].destroy()
+        view = None
+    if view is None:
+        view = build_notification_window()
+    msg_window = view['window']
+    msg_window.deiconify()
+    msg_window.attributes("-fullscreen", True)
+    msg_window.attributes("-topmost", True)
+    msg_window.lift()
+    msg_window.grab_set()
+    return view
+
+
+def release_notification_window(view):
+    """ Resets the window and returns it to the pool instead of destroying it. """
+    msg_window = view['window']
+    msg_window.grab_release()
+    msg_window.withdraw()
+    view['sender_label'].config(text="")
+    set_notification_content(view, "")
+    set_notification_attachments(view, [])
+    view['reply_entry'].delete(0, tk.END)
+    view['pending_label'].config(text="")
+    if len(window_pool) < NOTIFICATION_POOL_SIZE:
+        window_pool.append(view)
+    else:
+        msg_window.destroy()
+
+
+def render_current_notification():
+    notification = pending_notifications[0]
+    notification_view['window'].title(f"Notification from {notification['sender_user']}")
+    urgent = "NUJNO - " if notification['priority'] >= URGENT_PRIORITY else ""
+    notification_view['sender_label'].config(text=f"{urgent}Sporočilo od: {notification['sender_user']}")
+    set_notification_content(notification_view, notification['content'])
+    set_notification_attachments(notification_view, notification['attachments'])
+    reply_entry = notification_view['reply_entry']
+    reply_entry.delete(0, tk.END)
+    reply_entry.insert(0, notification['draft'])
+    update_pending_counter()
+    if notification['shown_at'] is None:
+        notification['shown_at'] = time.monotonic()
+        if notification['received_at'] is not None:
+            notifier_metrics.observe('notifier_receipt_to_shown_seconds',
+                                     notification['shown_at'] - notification['received_at'])
+            if notification['priority'] >= URGENT_PRIORITY:
+                notifier_metrics.observe('notifier_urgent_receipt_to_shown_seconds',
+                                         notification['shown_at'] - notification['received_at'])
+
+
+def set_notification_content(view, content):
+    if len(content) > LARGE_CONTENT_CHARS:
+        view['content_text'].pack_forget()
+        view['content_text'].config(text="")
+        view['content_holder'].pack_configure(fill="both", expand=True, padx=20)
+        view['content_view'].frame.pack(fill="both", expand=True)
+        view['content_view'].set_text(content)
+    else:
+        view['content_view'].frame.pack_forget()
+        view['content_view'].set_text("")
+        view['content_holder'].pack_configure(fill="none", expand=False, padx=0)
+        view['content_text'].pack()
+        view['content_text'].config(text=content)
+
+
+def attachment_label(attachment):
+    size = attachment['size']
+    if isinstance(size, (int, float)) and size > 0:
+        return f"Priloga: {attachment['name']} ({size / (1024 * 1024):.1f} MB)"
+    return f"Priloga: {attachment['name']}"
+
+
+def set_notification_attachments(view, attachments):
+    for button in view['attachments_frame'].winfo_children():
+        button.destroy()
+    for attachment in attachments:
+        if is_openable_attachment(attachment):
+            button = tk.Button(view['attachments_frame'], text=attachment_label(attachment), font=("Helvetica", 12),
+                               fg="blue", bg="white", bd=0, cursor="hand2")
+            button.config(command=functools.partial(open_attachment, attachment, button))
+        else:
+            button = tk.Button(view['attachments_frame'], text=f"{attachment_label(attachment)} - ni mogoče odpreti",
+                               font=("Helvetica", 12), bg="white", bd=0, state=tk.DISABLED)
+        button.pack(pady=2)
+
+
+def is_image_attachment(attachment):
+    content_type = attachment['content_type'] or ''
+    extension = os.path.splitext(attachment['name'])[1].lower()
+    return content_type.startswith('image/') or extension in IMAGE_EXTENSIONS
+
+
+def is_openable_attachment(attachment):
+    extension = os.path.splitext(attachment['name'])[1].lower()
+    return extension in IMAGE_EXTENSIONS or extension in DOCUMENT_EXTENSIONS
+
+
+def fetch_attachment(attachment, max_size):
+    """ Runs on the I/O executor: downloads the attachment (or finds it in the cache) and decodes images. """
     try:
-        pairing_thread = None
-        consumer_thread = None
-
-        # If a token already exists locally, start consuming immediately; otherwise, attempt pairing
-        if load_local_token():
-            consumer_thread = threading.Thread(target=start_consuming, daemon=True)
-            consumer_thread.start()
-            update_status("Using saved token; connected")
+        file_path = notifier.attachments.get(attachment)
+        if not is_image_attachment(attachment):
+            return file_path, None
+        from PIL import Image
+        with Image.open(file_path) as image:
+            image.thumbnail(max_size)  # Only ever scales down
+            return file_path, image.copy()
+    except Exception as e:
+        print(f"Error opening attachment {attachment['path']}: {e}")
+        return None, None
+
+
+def open_attachment(attachment, button):
+    button.config(text=f"{attachment_label(attachment)} - nalaganje...", state=tk.DISABLED)
+    max_size = (int(root.winfo_screenwidth() * 0.8), int(root.winfo_screenheight() * 0.8))
+    run_in_background(fetch_attachment, attachment, max_size,
+                      on_done=functools.partial(show_attachment, attachment, button))
+
+
+def show_attachment(attachment, button, result):
+    file_path, image = result
+    if button.winfo_exists():
+        if file_path is None:
+            button.config(text=f"{attachment_label(attachment)} - napaka pri nalaganju", state=tk.NORMAL)
         else:
-            pairing_thread = threading.Thread(target=attempt_pairing, daemon=True)
-            pairing_thread.start()
+            button.config(text=attachment_label(attachment), state=tk.NORMAL)
+    if file_path is None:
+        return
+    if image is not None:
+        show_image_viewer(attachment['name'], image)
+    else:
+        run_in_background(open_file, file_path)
+
+
+def open_file(file_path):
+    # Documents open in their default application; os.startfile would just as well run a program
+    if os.path.splitext(file_path)[1].lower() not in DOCUMENT_EXTENSIONS + IMAGE_EXTENSIONS:
+        print(f"Not opening {file_path}: not a document type")
+        return
+    if hasattr(os, 'startfile'):
+        os.startfile(file_path)
+    else:
+        import webbrowser
+        webbrowser.open(f"file://{os.path.abspath(file_path)}")
+
+
+def show_image_viewer(title, image):
+    from PIL import ImageTk
+    owner = notification_view['window'] if notification_view is not None else root
+    viewer = tk.Toplevel(owner)
+    viewer.title(title)
+    viewer.transient(owner)
+    viewer.attributes("-topmost", True)
+    tk_image = ImageTk.PhotoImage(image, master=viewer)
+    image_label = tk.Label(viewer, image=tk_image)
+    image_label.image = tk_image  # Keep reference
+    image_label.pack()
+
+    def close():
+        # The notification modal holds the grab while it is open; hand it back
+        viewer.grab_release()
+        viewer.destroy()
+        if notification_view is not None and notification_view['window'] is owner:
+            owner.grab_set()
+
+    tk.Button(viewer, text="Zapri", command=close, font=("Helvetica", 14)).pack(pady=10)
+    viewer.protocol("WM_DELETE_WINDOW", close)
+    viewer.grab_set()
+
+
+def update_pending_counter():
+    more_pending = len(pending_notifications) - 1
+    if more_pending > 0:
+        notification_view['pending_label'].config(text=f"Čakajoča obvestila: še {more_pending}")
+        notification_view['next_button'].config(state=tk.NORMAL)
+    else:
+        notification_view['pending_label'].config(text="")
+        notification_view['next_button'].config(state=tk.DISABLED)
+
+
+def show_next_notification():
+    # Keep whatever was typed so far and move the current notification to the back of the backlog
+    pending_notifications[0]['draft'] = notification_view['reply_entry'].get()
+    pending_notifications.rotate(-1)
+    show_pending_or_close()
+
+
+@notifier_profiling.span('acknowledge_message')
+def acknowledge_message():
+    notification = pending_notifications.popleft()
+    notifier_metrics.observe('notifier_shown_to_ack_seconds', time.monotonic() - notification['shown_at'])
+    user_response = notification_view['reply_entry'].get()
+    if user_response.strip():
+        status = 'replied'
+    else:
+        status = 'read'
+        user_response = None  # or set to empty string
+
+    notifier.send_response(notification['notification_id'], user_response, status, notification['channel'])
+    show_pending_or_close()
+
+
+def quit_app(*args):
+    """ Shuts the notifier down within SHUTDOWN_DEADLINE_SECONDS and ends the mainloop. """
+    notifier.shutdown()
+    root.destroy()
+
+
+def show_pending_or_close():
+    global notification_view
+    # Whatever expired while waiting in the backlog is skipped rather than shown
+    drop_expired_notifications()
+    if pending_notifications:
+        render_current_notification()
+    else:
+        release_notification_window(notification_view)
+        notification_view = None
+
+
+if __name__ == '__main__':
+    notifier = NotifierCore(TkSink())
+    # Covers exits that don't go through quit_app; a second shutdown() does nothing
+    atexit.register(notifier.shutdown)
+    # The handler only queues the shutdown: Tk must be torn down on its own thread
+    signal.signal(signal.SIGTERM, lambda signum, frame: run_on_ui(quit_app))
+    notifier_metrics.start_exporters(notifier.stop_event)
+    try:
+        # One thread runs the asyncio transport: loading local state, consuming, publishing, heartbeat and pairing.
+        # It starts first so the broker connection opens while Tk starts up.
+        notifier.start()
+        build_root()
+        notifier_profiling.install({'ui': run_on_ui, 'transport': notifier.call_on_transport})
+
+        # Only once the status window is up, as the pool is not needed until the first notification
+        root.after_idle(warm_up_notification_windows)
+
+        # Start draining results from background threads
+        root.after(0, process_ui_queue)
 
-        # Schedule the first heartbeat call in the Tkinter event loop
-        root.after(0, send_heartbeat)
+        # Measure mainloop lag and capture what blocks the Tk thread
+        if UI_WATCHDOG_PROBE_MS > 0:
+            start_ui_watchdog()
 
         # Start the Tkinter main loop
         root.mainloop()
     except KeyboardInterrupt:
         print("Exiting...")
-        stop_event.set()
-        if pairing_thread is not None:
-            pairing_thread.join(timeout=2)
-        send_sign_out()
-        print("Exited gracefully.")
\ No newline at end of file
+        notifier.shutdown()
+        print("Exited gracefully.")
+    # Also after quit_app; doesn't wait past the shutdown deadline for network calls still running
+    notifier.exit_process()
@@ -0,0 +1,119 @@
+""" Message codecs keyed on the AMQP content_type and content_encoding properties.
+
+Bodies are JSON or msgpack, optionally compressed with zlib or zstd. Anything without those properties is plain
+JSON, which stays the fallback both ways: msgpack and zstd are optional dependencies (pip install msgpack
+zstandard) and are only used when installed.
+"""
+import json
+import os
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Format of outgoing status and presence messages: 'json' (compact) or 'msgpack'
+STATUS_CONTENT_TYPE = os.getenv('STATUS_CONTENT_TYPE', 'json')
+# Compression of outgoing messages larger than COMPRESSION_MIN_BYTES: 'none', 'zlib' or 'zstd'
+STATUS_COMPRESSION = os.getenv('STATUS_COMPRESSION', 'none')
+COMPRESSION_MIN_BYTES = int(os.getenv('COMPRESSION_MIN_BYTES', '1024'))
+# Largest body a compressed message may expand to; anything bigger is treated as malformed
+MAX_DECOMPRESSED_BYTES = int(os.getenv('MAX_DECOMPRESSED_BYTES', '8388608'))
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+CONTENT_TYPES = {'json': JSON, 'msgpack': MSGPACK}
+# content_type values other publishers use for msgpack
+MSGPACK_ALIASES = (MSGPACK, 'application/x-msgpack', 'application/vnd.msgpack')
+
+# zstd contexts are reusable but not thread-safe; decoding runs on the transport loop, encoding on whoever publishes
+zstd_decompressor = zstandard.ZstdDecompressor() if zstandard is not None else None
+
+
+def inflate_zlib(body):
+    decompressor = zlib.decompressobj()
+    # One byte over the limit is enough to tell the body is too large, without inflating the rest of it
+    inflated = decompressor.decompress(body, MAX_DECOMPRESSED_BYTES + 1)
+    if len(inflated) > MAX_DECOMPRESSED_BYTES:
+        raise ValueError(f"zlib body expands to more than {MAX_DECOMPRESSED_BYTES} bytes")
+    if not decompressor.eof:
+        raise ValueError("truncated zlib body")
+    return inflated
+
+
+def inflate_zstd(body):
+    if zstd_decompressor is None:
+        raise ValueError("zstd-compressed message, but zstandard is not installed")
+    # Streaming, so frames written without a content size (stream_writer) decode too, and a size in the frame
+    # header is not trusted for the allocation
+    with zstd_decompressor.stream_reader(body) as reader:
+        inflated = reader.read(MAX_DECOMPRESSED_BYTES + 1)
+    if len(inflated) > MAX_DECOMPRESSED_BYTES:
+        raise ValueError(f"zstd body expands to more than {MAX_DECOMPRESSED_BYTES} bytes")
+    return inflated
+
+
+def decode(body, content_type=None, content_encoding=None):
+    """ Returns the message (a dict) carried by body; raises ValueError if it can't be decoded into one. """
+    try:
+        if content_encoding in ('zlib', 'deflate'):
+            body = inflate_zlib(body)
+        elif content_encoding == 'zstd':
+            body = inflate_zstd(body)
+        elif content_encoding not in (None, '', 'identity', 'utf-8'):
+            raise ValueError(f"unsupported content encoding {content_encoding!r}")
+        if content_type in MSGPACK_ALIASES:
+            if msgpack is None:
+                raise ValueError("msgpack message, but msgpack is not installed")
+            message = msgpack.unpackb(body, raw=False)
+        else:
+            message = json.loads(body)
+    except ValueError:
+        raise
+    except Exception as e:
+        # zlib.error, zstd and msgpack errors: all mean the same thing to the caller
+        raise ValueError(f"could not decode {content_type or JSON} body: {e}") from e
+    if not isinstance(message, dict):
+        raise ValueError(f"expected an object, got {type(message).__name__}")
+    return message
+
+
+def encode(message=None, content_type=STATUS_CONTENT_TYPE, compression=STATUS_COMPRESSION, json_text=None):
+    """ Serializes message for publishing and returns (body, content_type, content_encoding).
+
+    Instead of message, json_text may be given: the message already serialized as JSON, sent as is when the
+    format is JSON.
+    """
+    if content_type == 'msgpack' and msgpack is not None:
+        if message is None:
+            message = json.loads(json_text)
+        body = msgpack.packb(message, use_bin_type=True)
+    else:
+        content_type = 'json'
+        if json_text is None:
+            json_text = json.dumps(message, separators=(',', ':'))
+        body = json_text.encode('utf-8')
+
+    content_encoding = None
+    if len(body) >= COMPRESSION_MIN_BYTES:
+        if compression == 'zstd' and zstandard is not None:
+            body = zstandard.ZstdCompressor().compress(body)
+            content_encoding = 'zstd'
+        elif compression in ('zlib', 'zstd'):
+            body = zlib.compress(body)
+            content_encoding = 'zlib'
+    return body, CONTENT_TYPES[content_type], content_encoding
+
+
+def check_configuration():
+    # Optional formats that are configured but not installed fall back instead of failing every publish
+    if STATUS_CONTENT_TYPE == 'msgpack' and msgpack is None:
+        print("STATUS_CONTENT_TYPE=msgpack but msgpack is not installed; publishing JSON")
+    if STATUS_COMPRESSION == 'zstd' and zstandard is None:
+        print("STATUS_COMPRESSION=zstd but zstandard is not installed; compressing with zlib")
@@ -0,0 +1,1495 @@
+""" UI-independent notifier core: pairing, consuming, status publishing and heartbeats.
+
+Received notifications are handed to a NotificationSink. `app_v2.py` plugs in the Tkinter modal; running this
+module directly starts the client headless, logging notifications or forwarding them to NOTIFIER_FORWARD_URL.
+"""
+import asyncio
+import json
+import threading
+import os
+import socket
+from dotenv import load_dotenv
+import time
+import collections
+import datetime
+import functools
+import hashlib
+import signal
+import sqlite3
+import sys
+import random
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+# Load environment variables from a standard .env file if present; before the modules below, which read theirs
+# on import
+load_dotenv()
+
+import notifier_codecs  # noqa: E402
+import notifier_metrics  # noqa: E402
+import notifier_profiling  # noqa: E402
+
+API_BASE_URL = os.getenv('API_BASE_URL', 'http://localhost:8000')
+RABBITMQ_HOST = os.getenv('RABBITMQ_HOST', 'localhost')
+RABBITMQ_PORT = int(os.getenv('RABBITMQ_PORT', 5672))
+RABBITMQ_USERNAME = os.getenv('RABBITMQ_USERNAME', 'guest')
+RABBITMQ_PASSWORD = os.getenv('RABBITMQ_PASSWORD', 'guest')
+TOKEN_FILE_PATH = os.getenv('TOKEN_FILE_PATH', 'app/terminal_token.json')
+# Heartbeat interval in minutes (default 3)
+HEARTBEAT_MINS = int(os.getenv('HEARTBEAT_MINS', '3'))
+HEARTBEAT_MS = HEARTBEAT_MINS * 60 * 1000
+# 'http' POSTs /terminal_heartbeat/; 'amqp' publishes presence on the open broker connection and only falls back to
+# the REST heartbeat while the connection is down or presence was not accepted. Each interval is varied by up to
+# +/- HEARTBEAT_JITTER (a fraction) using a per-host random sequence so terminals don't beat in lockstep.
+HEARTBEAT_MODE = os.getenv('HEARTBEAT_MODE', 'http')
+HEARTBEAT_JITTER = float(os.getenv('HEARTBEAT_JITTER', '0.1'))
+# REST calls share one pooled keep-alive session: (connect, read) timeouts in seconds and connection retries per call
+HTTP_TIMEOUT = (float(os.getenv('HTTP_CONNECT_TIMEOUT', '3.05')), float(os.getenv('HTTP_READ_TIMEOUT', '10')))
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', '2'))
+# How long a looked-up external IP is reused before asking ipify again
+EXTERNAL_IP_CACHE_SECONDS = int(os.getenv('EXTERNAL_IP_CACHE_SECONDS', '3600'))
+# Status publishing: 'single' sends one message per status, 'batch' merges statuses into one message
+# per STATUS_BATCH_SIZE events or per STATUS_BATCH_FLUSH_MS window, whichever comes first.
+STATUS_PUBLISH_MODE = os.getenv('STATUS_PUBLISH_MODE', 'single')
+STATUS_BATCH_SIZE = int(os.getenv('STATUS_BATCH_SIZE', '50'))
+STATUS_BATCH_FLUSH_MS = int(os.getenv('STATUS_BATCH_FLUSH_MS', '500'))
+# Consumer acknowledgements: 'auto' acks on receipt; 'manual' acks each message only after it is queued locally
+# and its 'delivered' status has been confirmed by the broker, with at most CONSUMER_PREFETCH unacked in flight.
+CONSUMER_ACK_MODE = os.getenv('CONSUMER_ACK_MODE', 'auto')
+CONSUMER_PREFETCH = int(os.getenv('CONSUMER_PREFETCH', '10'))
+# queue_{token} is declared with x-max-priority so the broker hands over higher-priority messages (AMQP priority
+# property) first; 0 declares a plain FIFO queue. A queue that already exists without it stays FIFO.
+CONSUMER_MAX_PRIORITY = int(os.getenv('CONSUMER_MAX_PRIORITY', '10'))
+# Disk-backed outbox every outgoing status is written to before publishing (next to the token file by default)
+OUTBOX_PATH = os.getenv('OUTBOX_PATH', os.path.join(os.path.dirname(TOKEN_FILE_PATH), 'outbox.sqlite3'))
+# Published statuses are kept this long so redelivered notifications don't send the same status twice
+OUTBOX_RETENTION_HOURS = int(os.getenv('OUTBOX_RETENTION_HOURS', '168'))
+# Notification ids already shown, kept to drop redeliveries: an in-memory LRU of at most DEDUP_MAX_ENTRIES ids
+# backed by an append-only file next to the token file so the index survives restarts.
+DEDUP_FILE_PATH = os.getenv('DEDUP_FILE_PATH', os.path.join(os.path.dirname(TOKEN_FILE_PATH), 'seen_notifications.txt'))
+DEDUP_MAX_ENTRIES = int(os.getenv('DEDUP_MAX_ENTRIES', '10000'))
+# Reconnect/re-pair backoff uses decorrelated jitter between RECONNECT_BASE_SECONDS and RECONNECT_CAP_SECONDS,
+# so a fleet reconnecting after a broker restart spreads out instead of retrying in lockstep. A session that
+# stayed up for RECONNECT_RESET_SECONDS resets the backoff.
+RECONNECT_BASE_SECONDS = float(os.getenv('RECONNECT_BASE_SECONDS', '2'))
+RECONNECT_CAP_SECONDS = float(os.getenv('RECONNECT_CAP_SECONDS', '60'))
+RECONNECT_RESET_SECONDS = 60
+# Maximum number of outbox entries published per drain in 'single' mode, and unconfirmed at any time
+OUTBOX_DRAIN_LIMIT = 100
+# Worker threads for blocking network calls (heartbeat, pairing, sign-out) kept off the UI and transport threads
+IO_WORKERS = int(os.getenv('IO_WORKERS', '4'))
+# Attachments referenced by notifications are downloaded from API_BASE_URL only when opened, into a cache folder
+# next to the token file that is kept under ATTACHMENT_CACHE_MB by evicting the least recently opened files
+ATTACHMENT_CACHE_DIR = os.getenv('ATTACHMENT_CACHE_DIR', os.path.join(os.path.dirname(TOKEN_FILE_PATH), 'attachments'))
+ATTACHMENT_CACHE_MB = float(os.getenv('ATTACHMENT_CACHE_MB', '200'))
+# Group keys (comma-separated, e.g. site.ljubljana,department.obdelava,line.3) this terminal receives besides its own
+# notifications and broadcasts; the server can assign more at pairing
+NOTIFIER_GROUPS = [group.strip() for group in os.getenv('NOTIFIER_GROUPS', '').split(',') if group.strip()]
+# Graceful shutdown (logoff, reboot, Ctrl+C, SIGTERM) finishes within SHUTDOWN_DEADLINE_SECONDS: the consumer is
+# cancelled, queued statuses are flushed to the broker and the connection closed, and the terminal signs out in the
+# last SHUTDOWN_SIGN_OUT_SECONDS. Statuses not confirmed in time stay in the outbox for the next start.
+SHUTDOWN_DEADLINE_SECONDS = float(os.getenv('SHUTDOWN_DEADLINE_SECONDS', '4'))
+SHUTDOWN_SIGN_OUT_SECONDS = 1.5
+# Headless mode: if set, every received notification is POSTed as JSON to this URL instead of only being logged
+NOTIFIER_FORWARD_URL = os.getenv('NOTIFIER_FORWARD_URL')
+
+# Exchange and routing key used for delivery/read/reply statuses sent back to the server
+RESPONSES_EXCHANGE = 'notifications_responses'
+RESPONSES_ROUTING_KEY = 'django_server'
+# Broadcast and group notifications are routed into the same queue_{token} by a fanout exchange every terminal is
+# bound to and a topic exchange bound with the terminal's group keys, so the server publishes once per audience
+# instead of once per terminal
+BROADCAST_EXCHANGE = 'notifications_broadcast'
+GROUP_EXCHANGE = 'notifications_groups'
+# Fanout exchange carrying compact presence messages in HEARTBEAT_MODE=amqp
+PRESENCE_EXCHANGE = 'terminal_presence'
+
+# The first heartbeat waits until the client is listening, or this many seconds, so it doesn't compete with startup
+HEARTBEAT_STARTUP_DELAY = 30
+
+# pika and requests dominate import time; load_transport_modules imports them on the transport/I/O threads so a
+# UI can show its window first
+pika = None
+AsyncioConnection = None
+requests = None
+HTTPAdapter = None
+ConnectTimeout = None
+ConnectionError = None
+Retry = None
+transport_modules_lock = threading.Lock()
+
+# Last external IP lookup as (ip, monotonic time fetched)
+cached_external_ip = None
+
+# Blocking network I/O runs here, shared by every core in the process
+io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix='notifier-io')
+
+
+def load_transport_modules():
+    global pika, AsyncioConnection, requests, HTTPAdapter, ConnectTimeout, ConnectionError, Retry
+    if Retry is not None:
+        return
+    with transport_modules_lock:
+        import pika
+        from pika.adapters.asyncio_connection import AsyncioConnection
+        import requests
+        from requests.adapters import HTTPAdapter
+        from requests.exceptions import ConnectTimeout, ConnectionError
+        from urllib3.util.retry import Retry
+
+
+def build_http_session():
+    # Retries only cover failed connects (the request never left) and gateway errors on idempotent GETs
+    retries = Retry(
+        total=HTTP_RETRIES,
+        connect=HTTP_RETRIES,
+        read=0,
+        backoff_factor=0.5,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset(['GET']),
+    )
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=IO_WORKERS, max_retries=retries)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# Shared by every REST call so heartbeats and pairing reuse open connections to API_BASE_URL; built on first use
+http_session = None
+http_session_lock = threading.Lock()
+
+
+def get_http_session():
+    global http_session
+    if http_session is None:
+        load_transport_modules()
+        with http_session_lock:
+            if http_session is None:
+                http_session = build_http_session()
+    return http_session
+
+
+def api_post(path, data):
+    return get_http_session().post(f'{API_BASE_URL}{path}', data=data, timeout=HTTP_TIMEOUT)
+
+
+def get_external_ip():
+    global cached_external_ip
+    if API_BASE_URL == 'http://localhost:8000':
+        # Use localhost IP if running locally
+        return '127.0.0.1'
+    if cached_external_ip is not None and time.monotonic() - cached_external_ip[1] < EXTERNAL_IP_CACHE_SECONDS:
+        return cached_external_ip[0]
+    try:
+        response = get_http_session().get('https://api.ipify.org', timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+        external_ip = response.text
+        cached_external_ip = (external_ip, time.monotonic())
+        return external_ip
+    except requests.RequestException as e:
+        print(f"Error fetching external IP: {e}")
+        # A stale address is still better than none for pairing
+        return cached_external_ip[0] if cached_external_ip is not None else None
+
+
+def get_connection_parameters():
+    load_transport_modules()
+    credentials = pika.PlainCredentials(RABBITMQ_USERNAME, RABBITMQ_PASSWORD)
+    return pika.ConnectionParameters(host=RABBITMQ_HOST, port=RABBITMQ_PORT, credentials=credentials)
+
+
+async def run_in_io(func, *args):
+    # Blocking HTTP calls (requests) run on the I/O executor without blocking the transport loop
+    return await asyncio.get_running_loop().run_in_executor(io_executor, func, *args)
+
+
+class NotificationSink:
+    """ Receives what the core has to show. Both methods are called on the transport loop and must not block. """
+
+    def notify(self, notification):
+        """ notification is a dict with notification_id, sender_user, content, attachments, priority (0 unless
+        set; higher is more urgent), channel ('direct', 'broadcast' or 'group:<key>', to be passed back with the
+        response), sent_at and expires_at (time.time() seconds, or None), collapse_key (newer notifications with
+        the same key replace older ones still pending, or None) and received_at (time.monotonic()). attachments
+        is a list of {'path', 'name', 'size', 'content_type'} references, fetched only on demand through
+        NotifierCore.attachments. Notifications that expired before they arrived are not passed on.
+        """
+        raise NotImplementedError
+
+    def status(self, text):
+        pass
+
+
+class LoggingSink(NotificationSink):
+
+    def notify(self, notification):
+        priority = f" (priority {notification['priority']})" if notification['priority'] else ''
+        channel = f" via {notification['channel']}" if notification['channel'] != 'direct' else ''
+        print(f"Notification {notification['notification_id']} from {notification['sender_user']}{channel}{priority}: "
+              f"{notification['content']}")
+        for attachment in notification['attachments']:
+            print(f"  Attachment {attachment['name']}: {API_BASE_URL}{attachment['path']}")
+
+    def status(self, text):
+        print(f"Status: {text}")
+
+
+class ForwardingSink(LoggingSink):
+    """ Logs each notification and POSTs it as JSON to url on the I/O executor. """
+
+    # What the receiving service gets; received_at is a monotonic clock reading that means nothing outside this
+    # process
+    FIELDS = ('notification_id', 'sender_user', 'content', 'attachments', 'priority', 'channel', 'sent_at',
+              'expires_at', 'collapse_key')
+
+    def __init__(self, url):
+        self.url = url
+
+    def notify(self, notification):
+        super().notify(notification)
+        io_executor.submit(self.forward, notification)
+
+    def forward(self, notification):
+        try:
+            payload = {field: notification[field] for field in self.FIELDS}
+            response = get_http_session().post(self.url, json=payload, timeout=HTTP_TIMEOUT)
+            if response.status_code >= 400:
+                print(f"Forwarding notification {notification['notification_id']} failed: {response.status_code}")
+        except requests.RequestException as e:
+            print(f"Error forwarding notification {notification['notification_id']}: {e}")
+
+
+class StatusOutbox:
+    """ SQLite outbox every outgoing status is written to before it is published.
+
+    Shared by the enqueueing threads and the transport loop (guarded by lock); wake is called whenever there is
+    something new to publish.
+    """
+
+    def __init__(self, path, wake):
+        self.path = path
+        self.wake = wake
+        self.db = None
+        self.lock = threading.Lock()
+        # Outbox row id -> callbacks to run once the broker has confirmed that status. Not keyed by notification_id:
+        # rows without one (NULL ids are never equal in SQLite) must not confirm each other.
+        self.callbacks = {}
+        # Statuses created before this (left over from a previous run) are not receipt->delivered samples
+        self.started_at = time.time()
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        # notification_id has no declared type so ints and strings round-trip unchanged
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " notification_id,"
+            " status TEXT NOT NULL,"
+            " payload TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " sent_at REAL,"
+            " UNIQUE (notification_id, status))"
+        )
+        self.db.commit()
+        self.prune()
+        pending = self.db.execute("SELECT COUNT(*) FROM outbox WHERE sent_at IS NULL").fetchone()[0]
+        if pending:
+            print(f"Outbox has {pending} unsent status(es) from a previous run")
+
+    def enqueue(self, message, on_confirmed=None):
+        """ Writes the status to the outbox; a repeat of an already queued (notification_id, status) is ignored. """
+        key = (message['notification_id'], message['status'])
+        with self.lock:
+            cursor = self.db.execute(
+                "INSERT OR IGNORE INTO outbox (notification_id, status, payload, created_at) VALUES (?, ?, ?, ?)",
+                (key[0], key[1], json.dumps(message, separators=(',', ':')), time.time())
+            )
+            self.db.commit()
+            row_id = cursor.lastrowid
+            already_sent = False
+            if cursor.rowcount == 0:
+                row = self.db.execute(
+                    "SELECT id, sent_at FROM outbox WHERE notification_id IS ? AND status = ?", key
+                ).fetchone()
+                row_id = row[0]
+                already_sent = row[1] is not None
+            if on_confirmed is not None and not already_sent:
+                self.callbacks.setdefault(row_id, []).append(on_confirmed)
+        if already_sent:
+            print(f"Status '{key[1]}' for notification {key[0]} was already published")
+            if on_confirmed is not None:
+                on_confirmed()
+            return
+        self.wake()
+
+    def count_pending(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM outbox WHERE sent_at IS NULL").fetchone()[0]
+
+    def fetch_pending(self, limit):
+        # Rows are (id, notification_id, status, payload, created_at)
+        with self.lock:
+            return self.db.execute(
+                "SELECT id, notification_id, status, payload, created_at FROM outbox"
+                " WHERE sent_at IS NULL ORDER BY id LIMIT ?",
+                (limit,)
+            ).fetchall()
+
+    def prune(self):
+        cutoff = time.time() - OUTBOX_RETENTION_HOURS * 3600
+        with self.lock:
+            self.db.execute("DELETE FROM outbox WHERE sent_at IS NOT NULL AND sent_at < ?", (cutoff,))
+            self.db.commit()
+
+    def mark_confirmed(self, rows):
+        now = time.time()
+        callbacks = []
+        with self.lock:
+            self.db.executemany("UPDATE outbox SET sent_at = ? WHERE id = ?", [(now, row[0]) for row in rows])
+            self.db.commit()
+            for row in rows:
+                callbacks.extend(self.callbacks.pop(row[0], []))
+        for row in rows:
+            print(f"Broker accepted status '{row[2]}' for notification {row[1]}")
+            if row[2] == 'delivered' and row[4] >= self.started_at:
+                notifier_metrics.observe('notifier_receipt_to_delivered_seconds', now - row[4])
+        for on_confirmed in callbacks:
+            try:
+                on_confirmed()
+            except Exception as e:
+                print(f"Error in status confirmation callback: {e}")
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+
+class SeenIndex:
+    """ LRU of notification ids already received (str(id) -> None), backed by an append-only file.
+
+    With path None the index is kept in memory only.
+    """
+
+    def __init__(self, path, max_entries=DEDUP_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        # Ids written to the file, i.e. whose 'delivered' status was confirmed, newest last; compaction keeps these
+        self.persisted = collections.OrderedDict()
+        # Number of lines in the file at path
+        self.file_lines = 0
+        self.lock = threading.Lock()
+
+    def load(self):
+        if self.path is None:
+            return
+        if not os.path.exists(self.path):
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        with self.lock:
+            # Only the newest max_entries ids matter; later lines are newer
+            for key in lines[-self.max_entries:]:
+                self.entries[key] = None
+                self.entries.move_to_end(key)
+                self.persisted[key] = None
+                self.persisted.move_to_end(key)
+            self.file_lines = len(lines)
+        print(f"Loaded {len(self.entries)} seen notification id(s)")
+
+    def check_and_mark(self, notification_id):
+        """ Returns True if the id was seen before; otherwise records it in memory and returns False. """
+        key = str(notification_id)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return True
+            self.entries[key] = None
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return False
+
+    def persist(self, notification_id):
+        """ Appends the id to the on-disk index, compacting the file once it holds twice the LRU size. """
+        if self.path is None:
+            return
+        key = str(notification_id)
+        with self.lock:
+            self.persisted[key] = None
+            self.persisted.move_to_end(key)
+            while len(self.persisted) > self.max_entries:
+                self.persisted.popitem(last=False)
+            try:
+                if self.file_lines >= 2 * self.max_entries:
+                    # Ids only marked in memory are left out: their status may never be confirmed
+                    temp_path = f"{self.path}.tmp"
+                    with open(temp_path, 'w', encoding='utf-8') as f:
+                        f.writelines(f"{persisted}\n" for persisted in self.persisted)
+                    os.replace(temp_path, self.path)
+                    self.file_lines = len(self.persisted)
+                else:
+                    with open(self.path, 'a', encoding='utf-8') as f:
+                        f.write(f"{notification_id}\n")
+                    self.file_lines += 1
+            except OSError as e:
+                print(f"Error writing seen notifications: {e}")
+
+
+def parse_attachments(message):
+    """ Returns the attachment references carried by message, skipping any without a path under API_BASE_URL. """
+    attachments = []
+    for attachment in message.get('attachments') or ():
+        if not isinstance(attachment, dict):
+            continue
+        path = attachment.get('path')
+        if not isinstance(path, str) or not path.startswith('/'):
+            print(f"Ignoring attachment without a valid path: {attachment}")
+            continue
+        attachments.append({
+            'path': path,
+            'name': str(attachment.get('name') or os.path.basename(path.rstrip('/')) or 'attachment'),
+            'size': attachment.get('size'),
+            'content_type': attachment.get('content_type'),
+        })
+    return attachments
+
+
+def parse_time(value):
+    # Unix seconds, or ISO 8601 text (with a UTC offset; without one it is taken as local time)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    if isinstance(value, str):
+        # fromisoformat() only accepts the trailing Z (as Django writes UTC times) from Python 3.11
+        if value.endswith(('Z', 'z')):
+            value = value[:-1] + '+00:00'
+        try:
+            return datetime.datetime.fromisoformat(value).timestamp()
+        except ValueError:
+            print(f"Ignoring unreadable time {value!r}")
+    return None
+
+
+def sent_time(message, properties):
+    """ When the server sent the notification (time.time() seconds): the AMQP timestamp or a sent_at field. """
+    if properties.timestamp is not None:
+        return float(properties.timestamp)
+    return parse_time(message.get('sent_at'))
+
+
+def expiry_time(message, properties, sent_at):
+    """ When the notification stops being worth showing, or None if it doesn't expire.
+
+    Either an expires_at field, or the AMQP expiration property (a TTL in milliseconds) counted from sent_at.
+    """
+    expires_at = parse_time(message.get('expires_at'))
+    if expires_at is None and properties.expiration and sent_at is not None:
+        try:
+            expires_at = sent_at + int(properties.expiration) / 1000
+        except ValueError:
+            print(f"Ignoring unreadable expiration {properties.expiration!r}")
+    return expires_at
+
+
+def notification_channel(method):
+    """ 'direct' for a notification sent to this terminal alone, else 'broadcast' or 'group:<routing key>'. """
+    if method.exchange == BROADCAST_EXCHANGE:
+        return 'broadcast'
+    if method.exchange == GROUP_EXCHANGE:
+        return f'group:{method.routing_key}'
+    return 'direct'
+
+
+class AttachmentCache:
+    """ On-disk cache of attachments downloaded from API_BASE_URL, kept under max_bytes.
+
+    Files are named by a hash of their path and evicted least recently used first. Nothing is read from disk
+    until the first attachment is opened; get() blocks and belongs on the I/O executor.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        # File name -> size in bytes, least recently used first; None until loaded
+        self.files = None
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def load(self):
+        os.makedirs(self.path, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.path):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith('.part'):
+                # Left over from an interrupted download
+                self.remove(entry.name)
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, entry.name, stat.st_size))
+        self.files = collections.OrderedDict()
+        self.total_bytes = 0
+        for _, name, size in sorted(entries):
+            self.files[name] = size
+            self.total_bytes += size
+
+    def get(self, attachment):
+        """ Returns the local file holding the attachment, downloading it first if it is not cached. """
+        path = attachment['path']
+        extension = os.path.splitext(attachment['name'])[1][:16]
+        name = hashlib.sha256(path.encode('utf-8')).hexdigest() + extension
+        file_path = os.path.join(self.path, name)
+        with self.lock:
+            if self.files is None:
+                self.load()
+            if name in self.files:
+                self.files.move_to_end(name)
+                try:
+                    # The modification time is the LRU order across restarts
+                    os.utime(file_path)
+                    return file_path
+                except OSError:
+                    # Removed behind our back; download it again
+                    self.total_bytes -= self.files.pop(name)
+
+        size = self.download(f'{API_BASE_URL}{path}', file_path)
+        with self.lock:
+            self.total_bytes += size - self.files.pop(name, 0)
+            self.files[name] = size
+            while self.total_bytes > self.max_bytes and len(self.files) > 1:
+                evicted, evicted_size = self.files.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.remove(evicted)
+        return file_path
+
+    def download(self, url, file_path):
+        fd, temp_path = tempfile.mkstemp(suffix='.part', dir=self.path)
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                with get_http_session().get(url, timeout=HTTP_TIMEOUT, stream=True) as response:
+                    response.raise_for_status()
+                    for chunk in response.iter_content(chunk_size=64 * 1024):
+                        size += len(chunk)
+                        if size > self.max_bytes:
+                            raise ValueError(f"attachment {url} is larger than the attachment cache")
+                        f.write(chunk)
+            os.replace(temp_path, file_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return size
+
+    def remove(self, name):
+        try:
+            os.remove(os.path.join(self.path, name))
+        except OSError as e:
+            print(f"Error removing cached attachment {name}: {e}")
+
+
+class AmqpSession:
+    """ One broker connection carrying the consumer channel and a confirming publisher channel.
+
+    Lives entirely on the transport loop; `closed` resolves with the exception that ended the session.
+    """
+
+    def __init__(self, core):
+        self.core = core
+        self.loop = core.loop
+        self.connection = None
+        self.consume_channel = None
+        self.consumer_tag = None
+        self.publish_channel = None
+        self.closed = self.loop.create_future()
+        self.connection_closed = self.loop.create_future()
+        # Publisher confirms: delivery tag -> outbox rows carried by that message
+        self.in_flight = {}
+        self.returned_tags = set()
+        self.next_delivery_tag = 1
+        # Monotonic time before which rejected statuses are not retried
+        self.retry_at = 0
+        # Delivery tags of presence messages (-> monotonic time sent), and whether the last one was accepted
+        # (None until confirmed)
+        self.presence_tags = {}
+        self.presence_accepted = None
+
+    async def open(self):
+        opened = self.loop.create_future()
+
+        def on_open(connection):
+            if not opened.done():
+                opened.set_result(connection)
+
+        def on_open_error(connection, error):
+            if not isinstance(error, BaseException):
+                error = pika.exceptions.AMQPConnectionError(error)
+            self.end(error)
+            if not self.connection_closed.done():
+                self.connection_closed.set_result(None)
+
+        def on_close(connection, reason):
+            self.end(reason)
+            if not self.connection_closed.done():
+                self.connection_closed.set_result(None)
+
+        self.connection = AsyncioConnection(
+            get_connection_parameters(),
+            on_open_callback=on_open,
+            on_open_error_callback=on_open_error,
+            on_close_callback=on_close,
+            custom_ioloop=self.loop,
+        )
+        await self.wait(opened)
+
+        self.publish_channel = await self.open_channel()
+        # Declared once per connection rather than once per message
+        await self.call(self.publish_channel.exchange_declare,
+                        exchange=RESPONSES_EXCHANGE, exchange_type='direct', durable=True)
+        if HEARTBEAT_MODE == 'amqp':
+            await self.declare_exchange(PRESENCE_EXCHANGE, 'fanout')
+        self.publish_channel.add_on_return_callback(self.on_message_returned)
+        await self.call(self.publish_channel.confirm_delivery, self.on_delivery_confirmation)
+
+    async def start_consuming(self):
+        channel = await self.open_channel()
+        self.consume_channel = channel
+        exchange_name = 'notifications'
+        await self.call(channel.exchange_declare, exchange=exchange_name, exchange_type='direct', durable=True)
+
+        token = self.core.token
+        queue_name = f'queue_{token}'
+        await self.declare_consumer_queue(queue_name)
+        await self.call(channel.queue_bind, queue=queue_name, exchange=exchange_name, routing_key=token)
+        await self.bind_channels(queue_name)
+
+        manual_ack = CONSUMER_ACK_MODE == 'manual'
+        if manual_ack:
+            # Bound how much of the queue backlog the broker pushes into this client at once
+            await self.call(channel.basic_qos, prefetch_count=CONSUMER_PREFETCH)
+        consume_ok = await self.call(channel.basic_consume,
+                                     queue=queue_name, on_message_callback=self.core.on_notification_received,
+                                     auto_ack=not manual_ack)
+        self.consumer_tag = consume_ok.method.consumer_tag
+        print(f"Listening for notifications on queue {queue_name} with routing key {token}...")
+
+    async def bind_channels(self, queue_name):
+        """ Binds the queue to the broadcast exchange and to the terminal's groups, dropping groups it left. """
+        channel = self.consume_channel
+        # Independent requests; pika sends them one after another without waiting on each reply in between
+        await asyncio.gather(
+            self.declare_exchange(BROADCAST_EXCHANGE, 'fanout'),
+            self.declare_exchange(GROUP_EXCHANGE, 'topic'),
+        )
+        groups = self.core.groups()
+        left = [group for group in self.core.bound_groups if group not in groups]
+        await asyncio.gather(
+            self.call(channel.queue_bind, queue=queue_name, exchange=BROADCAST_EXCHANGE, routing_key=''),
+            *(self.call(channel.queue_bind, queue=queue_name, exchange=GROUP_EXCHANGE, routing_key=group)
+              for group in groups),
+            *(self.call(channel.queue_unbind, queue=queue_name, exchange=GROUP_EXCHANGE, routing_key=group)
+              for group in left),
+        )
+        if groups:
+            print(f"Receiving broadcasts and groups {', '.join(groups)}")
+        if groups != self.core.bound_groups:
+            # Remembered with the token so groups removed later can be unbound from the durable queue
+            self.core.bound_groups = groups
+            await run_in_io(self.core.save_local_token, self.core.token)
+
+    async def declare_consumer_queue(self, queue_name):
+        """ Declares the consumer queue with x-max-priority, keeping an existing queue declared otherwise as is. """
+        if CONSUMER_MAX_PRIORITY > 0:
+            arguments = {'x-max-priority': CONSUMER_MAX_PRIORITY}
+            wanted = f"x-max-priority {CONSUMER_MAX_PRIORITY}"
+        else:
+            arguments = None
+            wanted = "no x-max-priority"
+        if await self.declare_separately('queue_declare', queue=queue_name, durable=True, arguments=arguments):
+            return
+        if not self.core.queue_arguments_reported:
+            self.core.queue_arguments_reported = True
+            print(f"Queue {queue_name} already exists with other arguments than requested ({wanted}); consuming from "
+                  f"it as declared until it is deleted and declared again")
+
+    async def declare_exchange(self, exchange, exchange_type):
+        """ Declares a durable exchange; one the backend already declared differently is used as it is. """
+        if not await self.declare_separately('exchange_declare', exchange=exchange, exchange_type=exchange_type,
+                                             durable=True):
+            print(f"Exchange {exchange} already exists with settings other than a durable {exchange_type} "
+                  f"exchange; using it as declared")
+
+    async def declare_separately(self, method_name, **kwargs):
+        """ Runs a queue or exchange declaration on a channel of its own; returns False if the broker refused it.
+
+        Arguments can't change once declared and the broker closes the channel that tries (406), so the
+        declaration must not end the session's channels with it.
+        """
+        opened = self.loop.create_future()
+        refused = self.loop.create_future()
+        channel = self.connection.channel(on_open_callback=lambda ch: opened.done() or opened.set_result(ch))
+        channel.add_on_close_callback(lambda ch, reason: refused.done() or refused.set_result(reason))
+        await self.wait(opened)
+        declared = self.loop.create_future()
+        getattr(channel, method_name)(callback=lambda frame: declared.done() or declared.set_result(frame), **kwargs)
+        await asyncio.wait([declared, refused, self.closed], return_when=asyncio.FIRST_COMPLETED)
+        if declared.done():
+            channel.close()
+            return True
+        if self.closed.done():
+            raise self.closed.result()
+        reason = refused.result()
+        if getattr(reason, 'reply_code', None) != 406:
+            raise reason
+        return False
+
+    async def open_channel(self):
+        opened = self.loop.create_future()
+        channel = self.connection.channel(
+            on_open_callback=lambda ch: opened.done() or opened.set_result(ch)
+        )
+        channel.add_on_close_callback(lambda ch, reason: self.end(reason))
+        return await self.wait(opened)
+
+    async def call(self, method, *args, **kwargs):
+        """ Runs a callback-style channel method and waits for its reply frame. """
+        reply = self.loop.create_future()
+        method(*args, callback=lambda frame: reply.done() or reply.set_result(frame), **kwargs)
+        return await self.wait(reply)
+
+    async def wait(self, future):
+        # Whatever ends the session (connection loss, channel closed by broker) also ends the wait
+        await asyncio.wait([future, self.closed], return_when=asyncio.FIRST_COMPLETED)
+        if not future.done():
+            raise self.closed.result()
+        return future.result()
+
+    def end(self, reason):
+        if not self.closed.done():
+            self.closed.set_result(reason)
+        if self.connection is not None and not (self.connection.is_closing or self.connection.is_closed):
+            self.connection.close()
+
+    async def cancel_consumer(self, timeout):
+        """ Stops new deliveries; the channel stays open so acks for messages already received can still go out. """
+        if self.consumer_tag is None or not self.consume_channel.is_open:
+            return
+        cancelled = self.loop.create_future()
+        self.consume_channel.basic_cancel(self.consumer_tag,
+                                          callback=lambda frame: cancelled.done() or cancelled.set_result(frame))
+        await asyncio.wait([cancelled, self.closed], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+    async def close(self, timeout=2):
+        self.end(pika.exceptions.ConnectionClosedByClient(200, 'Normal shutdown'))
+        if self.connection is not None:
+            await asyncio.wait([self.connection_closed], timeout=timeout)
+
+    def in_flight_ids(self):
+        return {row[0] for rows in self.in_flight.values() for row in rows}
+
+    def publish_statuses(self, rows):
+        # Outbox payloads are compact JSON already, so in JSON format a single status is published as stored
+        if STATUS_PUBLISH_MODE == 'batch':
+            batch = {'statuses': [json.loads(row[3]) for row in rows]}
+            messages = [(notifier_codecs.encode(batch), 'status_batch', rows)]
+        else:
+            messages = [(notifier_codecs.encode(json_text=row[3]), None, [row]) for row in rows]
+        for (body, content_type, content_encoding), message_type, entries in messages:
+            delivery_tag = self.next_delivery_tag
+            self.next_delivery_tag += 1
+            self.in_flight[delivery_tag] = entries
+            self.publish_channel.basic_publish(
+                exchange=RESPONSES_EXCHANGE,
+                routing_key=RESPONSES_ROUTING_KEY,
+                body=body,
+                properties=pika.BasicProperties(
+                    delivery_mode=2, type=message_type, message_id=str(delivery_tag),
+                    content_type=content_type, content_encoding=content_encoding
+                ),
+                mandatory=True
+            )
+
+    def publish_presence(self):
+        # Shares the confirming channel, so it takes a delivery tag like any status message
+        delivery_tag = self.next_delivery_tag
+        payload = {'h': self.core.hostname, 't': self.core.token, 'ts': int(time.time())}
+        body, content_type, content_encoding = notifier_codecs.encode(payload)
+        self.publish_channel.basic_publish(
+            exchange=PRESENCE_EXCHANGE,
+            routing_key='',
+            body=body,
+            # Transient and expiring: a presence message is worthless once the next one is due
+            properties=pika.BasicProperties(
+                delivery_mode=1, type='presence', message_id=str(delivery_tag), expiration=str(HEARTBEAT_MS),
+                content_type=content_type, content_encoding=content_encoding
+            ),
+            mandatory=True
+        )
+        # Only once it went out: a publish on a closed channel raises and uses up no tag
+        self.next_delivery_tag += 1
+        self.in_flight[delivery_tag] = []
+        self.presence_tags[delivery_tag] = time.monotonic()
+
+    def on_message_returned(self, channel, method, properties, body):
+        # Unroutable: the broker still acks it, so remember the tag to treat that ack as a failure
+        print(f"Message returned by broker: {method.reply_text}")
+        self.returned_tags.add(int(properties.message_id))
+
+    def on_delivery_confirmation(self, method_frame):
+        method = method_frame.method
+        if method.multiple:
+            delivery_tags = [tag for tag in self.in_flight if tag <= method.delivery_tag]
+        else:
+            delivery_tags = [method.delivery_tag]
+        accepted = []
+        rejected = 0
+        for delivery_tag in delivery_tags:
+            rows = self.in_flight.pop(delivery_tag, None)
+            if rows is None:
+                continue
+            acked = isinstance(method, pika.spec.Basic.Ack) and delivery_tag not in self.returned_tags
+            if acked:
+                accepted.extend(rows)
+            else:
+                rejected += len(rows)
+                notifier_metrics.inc('notifier_publish_failures_total')
+            if delivery_tag in self.presence_tags:
+                sent_at = self.presence_tags.pop(delivery_tag)
+                if acked:
+                    notifier_metrics.observe('notifier_heartbeat_rtt_seconds', time.monotonic() - sent_at)
+                elif self.presence_accepted is not False:
+                    # This heartbeat did not count: send it over REST now rather than at the next interval
+                    print("Presence was not accepted by the broker; sending REST heartbeat instead")
+                    self.loop.run_in_executor(io_executor, self.core.send_heartbeat)
+                self.presence_accepted = acked
+            self.returned_tags.discard(delivery_tag)
+        if accepted:
+            self.core.outbox.mark_confirmed(accepted)
+        if rejected:
+            # The connection is fine; the statuses stay in the outbox and are retried after a pause
+            print(f"Broker did not accept {rejected} status(es), retrying later")
+            self.retry_at = time.monotonic() + 5
+        self.core.outbox_wakeup.set()
+
+
+class ReconnectSupervisor:
+    """ State machine that keeps the transport paired and consuming.
+
+    pairing/re-pairing -> connecting -> consuming, with every failure going through backoff. Backoff delays use
+    decorrelated jitter and each pairing/connect attempt is timed and kept in `attempts`.
+    """
+
+    PAIRING = 'pairing'
+    REPAIRING = 're-pairing'
+    CONNECTING = 'connecting'
+    CONSUMING = 'consuming'
+    BACKOFF = 'backoff'
+
+    def __init__(self, core):
+        self.core = core
+        self.state = None
+        self.retry_state = self.CONNECTING
+        self.delay = RECONNECT_BASE_SECONDS
+        self.session = None
+        # Task opening self.session ahead of connect(), see prewarm()
+        self.opening = None
+        # Set while consuming
+        self.listening = asyncio.Event()
+        self.attempts = collections.deque(maxlen=50)
+        self.reconnects = 0
+
+    def transition(self, state):
+        print(f"Transport state: {self.state} -> {state}")
+        self.state = state
+        if state == self.CONSUMING:
+            self.listening.set()
+        else:
+            self.listening.clear()
+
+    def prewarm(self):
+        """ Starts opening a broker session right away, while the token is still being loaded or paired for. """
+        self.session = AmqpSession(self.core)
+        self.opening = asyncio.ensure_future(self.session.open())
+        # A failure is reported when connect() awaits it; don't warn about it if the session is never used
+        self.opening.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+    def next_delay(self):
+        # Decorrelated jitter: random between the base and three times the previous delay, capped
+        self.delay = min(RECONNECT_CAP_SECONDS, random.uniform(RECONNECT_BASE_SECONDS, self.delay * 3))
+        return self.delay
+
+    def record_attempt(self, kind, started, outcome):
+        duration = time.monotonic() - started
+        self.attempts.append({'kind': kind, 'at': time.time(), 'duration': duration, 'outcome': outcome})
+        print(f"{kind.capitalize()} attempt {outcome} after {duration:.2f}s")
+
+    def fail(self, retry_state):
+        self.retry_state = retry_state
+        self.transition(self.BACKOFF)
+
+    async def run(self):
+        core = self.core
+        self.transition(self.PAIRING if core.token is None else self.CONNECTING)
+        while not core.stop_event.is_set():
+            if self.state in (self.PAIRING, self.REPAIRING):
+                await self.pair()
+            elif self.state == self.CONNECTING:
+                await self.connect()
+            elif self.state == self.CONSUMING:
+                if not await self.consume():
+                    break
+            elif self.state == self.BACKOFF:
+                delay = self.next_delay()
+                if self.retry_state == self.CONNECTING:
+                    core.update_status(f"Reconnecting in {delay:.0f} seconds...")
+                else:
+                    core.update_status(f"Pairing failed, retrying in {delay:.0f} seconds...")
+                if await core.wait_for_stop(delay):
+                    break
+                self.transition(self.retry_state)
+
+    async def pair(self):
+        started = time.monotonic()
+        if await run_in_io(self.core.pair_with_server):
+            self.record_attempt(self.state, started, 'succeeded')
+            self.transition(self.CONNECTING)
+        else:
+            self.record_attempt(self.state, started, 'failed')
+            self.fail(self.state)
+
+    async def connect(self):
+        started = time.monotonic()
+        opening, self.opening = self.opening, None
+        if opening is None or self.session.closed.done():
+            self.session = AmqpSession(self.core)
+            opening = self.session.open()
+        try:
+            await opening
+            await self.session.start_consuming()
+        except Exception as e:
+            self.session.end(e)
+            notifier_metrics.inc('notifier_connect_failures_total')
+            self.record_attempt('connect', started, 'failed')
+            self.on_session_lost(e)
+            return
+        self.record_attempt('connect', started, 'succeeded')
+        self.transition(self.CONSUMING)
+
+    async def consume(self):
+        """ Returns False once the client is shutting down. """
+        self.core.update_status("Connected and Listening")
+        consuming_since = time.monotonic()
+        reason = await self.core.consume_until_closed(self.session)
+        if reason is None:
+            return False
+        self.reconnects += 1
+        notifier_metrics.inc('notifier_reconnects_total')
+        healthy = time.monotonic() - consuming_since > RECONNECT_RESET_SECONDS
+        if healthy:
+            # The connection was healthy for a while, so start the next backoff from scratch
+            self.delay = RECONNECT_BASE_SECONDS
+        self.on_session_lost(reason, healthy)
+        return True
+
+    def on_session_lost(self, reason, healthy=False):
+        """ Picks the next state after a failed connect or a lost session; healthy if it had consumed for a while. """
+        if isinstance(reason, pika.exceptions.ChannelClosedByBroker) and reason.reply_code == 406:
+            # The broker objects to how something was declared; a new token would be refused the same way
+            print(f"Channel closed by broker: {reason}")
+            self.core.update_status("Broker refused the queue setup, retrying...")
+            self.fail(self.CONNECTING)
+            return
+        if isinstance(reason, pika.exceptions.ChannelClosedByBroker):
+            print(f"Channel closed by broker: {reason}")
+            self.core.update_status("Token invalid or expired. Re-pairing...")
+            if healthy:
+                self.transition(self.REPAIRING)
+            else:
+                # Refused again straight after (re-)pairing: back off rather than mint a new token every round trip
+                self.fail(self.REPAIRING)
+            return
+        if isinstance(reason, pika.exceptions.AMQPConnectionError):
+            print(f"RabbitMQ connection error: {reason!r}")
+            self.core.update_status("Connection lost, reconnecting...")
+        else:
+            print(f"Unexpected error in transport: {reason!r}")
+            self.core.update_status("Unexpected error, reconnecting...")
+        self.fail(self.CONNECTING)
+
+
+class NotifierCore:
+    """ One terminal: its token, outbox, dedup index and the transport that pairs, consumes and publishes.
+
+    Everything network-facing runs on one asyncio loop, either a thread of its own (start/stop) or a loop shared
+    with other cores (await run()). Pass None as token_file_path or dedup_file_path to keep those in memory only.
+    """
+
+    def __init__(self, sink, hostname=None, token_file_path=TOKEN_FILE_PATH, outbox_path=OUTBOX_PATH,
+                 dedup_file_path=DEDUP_FILE_PATH, attachment_cache_path=ATTACHMENT_CACHE_DIR):
+        self.sink = sink
+        self.hostname = hostname or socket.gethostname()
+        self.token_file_path = token_file_path
+        self.token = None
+        # Group keys assigned by the server at pairing, and the group keys queue_{token} is bound to
+        self.paired_groups = []
+        self.bound_groups = []
+        # Whether open() has loaded the outbox, dedup index and token, and what kept it from doing so
+        self.opened = False
+        self.open_error = None
+        self.stop_event = threading.Event()
+        # Monotonic time by which a stop() should be done, and whether shutdown() has run
+        self.stop_deadline = None
+        self.shut_down = False
+        self.shutdown_ends_at = None
+        self.shutdown_lock = threading.Lock()
+        self.outbox = StatusOutbox(outbox_path, self.wake_publisher)
+        self.seen = SeenIndex(dedup_file_path)
+        # Whether the consumer queue being kept with other arguments has been logged
+        self.queue_arguments_reported = False
+        self.attachments = AttachmentCache(attachment_cache_path, int(ATTACHMENT_CACHE_MB * 1024 * 1024))
+        self.supervisor = None
+        self.thread = None
+        # Transport loop and the events living on it; set while run() is active
+        self.loop = None
+        self.stopping = None
+        # Set whenever a status is written to the outbox or confirmed, waking the outbox drain
+        self.outbox_wakeup = None
+
+    def load_local_token(self):
+        if self.token_file_path is not None and os.path.exists(self.token_file_path):
+            with open(self.token_file_path, 'r') as f:
+                data = json.load(f)
+                self.token = data.get('token')
+                self.paired_groups = data.get('groups') or []
+                self.bound_groups = data.get('bound_groups') or []
+                print(f"Loaded token from file: {self.token}")
+                return True
+        return False
+
+    def save_local_token(self, token):
+        if self.token_file_path is None:
+            return
+        os.makedirs(os.path.dirname(self.token_file_path) or '.', exist_ok=True)
+        with open(self.token_file_path, 'w') as f:
+            json.dump({'token': token, 'groups': self.paired_groups, 'bound_groups': self.bound_groups}, f)
+        print(f"Token saved locally: {token}")
+
+    def groups(self):
+        """ Group keys this terminal receives: NOTIFIER_GROUPS and those assigned at pairing. """
+        return list(dict.fromkeys(NOTIFIER_GROUPS + self.paired_groups))
+
+    def update_status(self, new_status):
+        self.sink.status(new_status)
+
+    def open(self):
+        """ Opens the outbox and dedup index and loads the saved token, if any. """
+        # Statuses are written to the outbox first, then drained over the transport's broker connection
+        self.outbox.open()
+        self.seen.load()
+        # If a token already exists locally, start consuming immediately; otherwise, the transport pairs first
+        if self.load_local_token():
+            self.update_status("Using saved token; connected")
+        self.opened = True
+
+    def send_sign_out(self):
+        try:
+            api_post('/terminal_sign_out/', {'hostname': self.hostname})
+            print("Sent sign out signal.")
+        except Exception as e:
+            print(f"Error sending sign out: {e}")
+
+    def send_heartbeat(self):
+        """ Sends one heartbeat signal; runs on the I/O executor. """
+        try:
+            started = time.monotonic()
+            response = api_post('/terminal_heartbeat/', {'hostname': self.hostname})
+            if response.status_code == 200:
+                notifier_metrics.observe('notifier_heartbeat_rtt_seconds', time.monotonic() - started)
+                print("Heartbeat sent successfully.")
+            else:
+                print(f"Heartbeat failed: {response.content}")
+        except Exception as e:
+            print(f"Error sending heartbeat: {e}")
+
+    def pair_with_server(self):
+        external_ip = get_external_ip()
+
+        self.update_status("Pairing...")
+        try:
+            response = api_post('/pair/', {'external_ip': external_ip, 'hostname': self.hostname})
+            if response.status_code == 200:
+                data = response.json()
+                self.token = data.get('token')
+                self.paired_groups = [str(group) for group in data.get('groups') or []]
+                # A new pairing comes with a new queue, bound to nothing yet
+                self.bound_groups = []
+                print(f"Successfully paired with token: {self.token}")
+                self.save_local_token(self.token)
+                self.update_status("Paired with server")
+                return True
+            else:
+                print("Pairing failed.")
+                self.update_status("Pairing failed.")
+                return False
+        except (ConnectTimeout, ConnectionError) as e:
+            print(f"Connection error during pairing: {e}")
+            self.update_status("Connection failed, retrying...")
+            return False
+        except Exception as e:
+            print(f"Unexpected error during pairing: {e}")
+            self.update_status("Unexpected error, retrying...")
+            return False
+
+    @notifier_profiling.span('send_status_update')
+    def send_status_update(self, notification_id, status, on_confirmed=None, channel='direct'):
+        """ Queues a status for the publisher; on_confirmed runs on the transport loop once the broker accepts it. """
+        message = {
+            'notification_id': notification_id,
+            'status': status
+        }
+        self.outbox.enqueue(self.tag_channel(message, channel), on_confirmed)
+
+    def send_response(self, notification_id, user_response, status, channel='direct'):
+        """ Queues the 'read'/'replied' status for a notification; safe to call from any thread. """
+        message = {
+            'notification_id': notification_id,
+            'user_response': user_response,
+            'status': status
+        }
+        self.outbox.enqueue(self.tag_channel(message, channel))
+
+    def tag_channel(self, message, channel):
+        # A broadcast or group notification id is shared by many terminals, so its statuses say which one sent them
+        if channel != 'direct':
+            message['channel'] = channel
+            message['token'] = self.token
+        return message
+
+    def call_on_transport(self, callback):
+        # Safe from any thread; dropped if the transport loop is not running
+        loop = self.loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(callback)
+            except RuntimeError:
+                pass  # Loop already closed
+
+    def wake_publisher(self):
+        # Safe from any thread; the outbox drain runs on the transport loop
+        loop = self.loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self.outbox_wakeup.set)
+            except RuntimeError:
+                pass  # Loop already closed during shutdown; the entry stays in the outbox
+
+    @notifier_profiling.span('on_notification_received')
+    def on_notification_received(self, ch, method, properties, body):
+        received_at = time.monotonic()
+        notifier_metrics.inc('notifier_messages_received_total')
+        manual_ack = CONSUMER_ACK_MODE == 'manual'
+        try:
+            with notifier_profiling.timed('decode'):
+                message = notifier_codecs.decode(body, properties.content_type, properties.content_encoding)
+        except ValueError as e:
+            print(f"Discarding malformed notification: {e}")
+            if manual_ack:
+                ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            return
+        notification_id = message.get('notification_id')
+
+        # Drop redeliveries and server retries before any UI or status work
+        if notification_id is not None and self.seen.check_and_mark(notification_id):
+            print(f"Skipping duplicate notification {notification_id}")
+            notifier_metrics.inc('notifier_duplicates_dropped_total')
+            if manual_ack:
+                ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+
+        source = notification_channel(method)
+        sent_at = sent_time(message, properties)
+        expires_at = expiry_time(message, properties, sent_at)
+        # In manual mode the message is acked once its receipt status ('delivered' or 'expired') is confirmed
+        on_confirmed = None
+        if notification_id is not None:
+            on_confirmed = functools.partial(self.on_delivered_confirmed, ch, method.delivery_tag, notification_id)
+        elif manual_ack:
+            on_confirmed = functools.partial(self.ack_delivery, ch, method.delivery_tag)
+
+        # Obsolete already, e.g. queued while the terminal was off: report it instead of showing it
+        if expires_at is not None and time.time() >= expires_at:
+            print(f"Dropping expired notification {notification_id}")
+            notifier_metrics.inc('notifier_expired_dropped_total')
+            self.send_status_update(notification_id, status='expired', on_confirmed=on_confirmed, channel=source)
+            return
+
+        # Hand the notification to the sink; from here on it is queued locally
+        # The AMQP priority property, or a priority field for publishers that can't set properties
+        priority = properties.priority if properties.priority is not None else message.get('priority')
+        self.sink.notify({
+            'notification_id': notification_id,
+            'sender_user': message.get('sender_user'),
+            'content': message.get('notification_content'),
+            'attachments': parse_attachments(message),
+            'priority': min(255, max(0, priority)) if isinstance(priority, int) else 0,
+            'channel': source,
+            'sent_at': sent_at,
+            'expires_at': expires_at,
+            'collapse_key': message.get('collapse_key'),
+            'received_at': received_at,
+        })
+
+        # Send 'delivered' status back to the server
+        self.send_status_update(notification_id, status='delivered', on_confirmed=on_confirmed,
+                                channel=source)
+
+    def on_delivered_confirmed(self, channel, delivery_tag, notification_id):
+        # Persist only once the receipt status is confirmed, so a crash before that still lets the redelivery through
+        self.seen.persist(notification_id)
+        if CONSUMER_ACK_MODE == 'manual':
+            self.ack_delivery(channel, delivery_tag)
+
+    def ack_delivery(self, channel, delivery_tag):
+        # Runs on the transport loop; delivery tags are only valid on the channel that received the message
+        if channel.is_open:
+            channel.basic_ack(delivery_tag=delivery_tag)
+        else:
+            # The consumer channel is gone; the broker will redeliver the message after reconnect
+            print(f"Could not ack delivery {delivery_tag}: consumer channel closed")
+
+    async def wait_for_wakeup(self, session, timeout):
+        waiter = asyncio.ensure_future(self.outbox_wakeup.wait())
+        await asyncio.wait([waiter, session.closed], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        waiter.cancel()
+
+    async def drain_outbox(self, session):
+        """ Publishes outbox entries over the session until it ends; confirmed entries are marked sent. """
+        last_prune = time.monotonic()
+        while not session.closed.done():
+            self.outbox_wakeup.clear()
+            if time.monotonic() - last_prune > 3600:
+                self.outbox.prune()
+                last_prune = time.monotonic()
+            retry_delay = session.retry_at - time.monotonic()
+            if retry_delay > 0:
+                await asyncio.wait([session.closed], timeout=retry_delay)
+                continue
+            in_flight_ids = session.in_flight_ids()
+            if len(in_flight_ids) >= OUTBOX_DRAIN_LIMIT:
+                await self.wait_for_wakeup(session, None)
+                continue
+            limit = STATUS_BATCH_SIZE if STATUS_PUBLISH_MODE == 'batch' else OUTBOX_DRAIN_LIMIT - len(in_flight_ids)
+            rows = [row for row in self.outbox.fetch_pending(limit + len(in_flight_ids)) if row[0] not in in_flight_ids]
+            rows = rows[:limit]
+            if not rows:
+                await self.wait_for_wakeup(session, 3600)
+                continue
+            if STATUS_PUBLISH_MODE == 'batch' and len(rows) < STATUS_BATCH_SIZE and not self.stop_event.is_set():
+                # Let the flush window fill up, unless the oldest status has already waited that long
+                remaining = rows[0][4] + STATUS_BATCH_FLUSH_MS / 1000 - time.time()
+                if remaining > 0:
+                    await self.wait_for_wakeup(session, remaining)
+                    continue
+            session.publish_statuses(rows)
+
+    async def wait_for_stop(self, timeout):
+        """ Sleeps up to timeout seconds; returns True if the client is shutting down. """
+        try:
+            await asyncio.wait_for(self.stopping.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.stop_event.is_set()
+
+    async def heartbeat_loop(self):
+        """ Periodically sends a heartbeat signal, as broker presence in 'amqp' mode while the session is up. """
+        supervisor = self.supervisor
+        jitter = random.Random(self.hostname)
+        try:
+            await asyncio.wait_for(supervisor.listening.wait(), HEARTBEAT_STARTUP_DELAY)
+        except asyncio.TimeoutError:
+            pass
+        while not self.stop_event.is_set():
+            session = supervisor.session
+            presence_sent = False
+            if HEARTBEAT_MODE == 'amqp' and supervisor.state == supervisor.CONSUMING:
+                try:
+                    session.publish_presence()
+                    presence_sent = True
+                except Exception as e:
+                    print(f"Error publishing presence: {e}")
+            # Once presence was refused, REST carries the heartbeat until a presence message is accepted again
+            if not presence_sent or session.presence_accepted is False:
+                await run_in_io(self.send_heartbeat)
+            interval = HEARTBEAT_MS / 1000 * (1 + jitter.uniform(-HEARTBEAT_JITTER, HEARTBEAT_JITTER))
+            if await self.wait_for_stop(interval):
+                break
+
+    async def consume_until_closed(self, session):
+        """ Runs the outbox drain while the session consumes; returns what ended it, or None on shutdown. """
+        drain_task = asyncio.ensure_future(self.drain_outbox(session))
+        stop_task = asyncio.ensure_future(self.stopping.wait())
+        await asyncio.wait([session.closed, stop_task], return_when=asyncio.FIRST_COMPLETED)
+        stop_task.cancel()
+        if self.stop_event.is_set():
+            await self.finish_session(session, drain_task)
+            return None
+        drain_task.cancel()
+        return session.closed.result()
+
+    async def finish_session(self, session, drain_task):
+        """ Shutdown: stops deliveries, lets the drain flush queued statuses until stop_deadline, then closes. """
+        def remaining():
+            return self.stop_deadline - time.monotonic()
+
+        await session.cancel_consumer(max(0, remaining()))
+        # Cut a batch flush window short; the drain publishes whatever is queued right away while stopping
+        self.outbox_wakeup.set()
+        # Leave a little of the deadline for closing the connection
+        while not session.closed.done() and remaining() > 0.25 and self.outbox.count_pending():
+            await asyncio.wait([session.closed], timeout=0.05)
+        drain_task.cancel()
+        unsent = self.outbox.count_pending()
+        if unsent:
+            print(f"{unsent} status(es) not confirmed before shutdown; they stay in the outbox for the next start")
+        else:
+            print("All statuses confirmed")
+        await session.close(max(0.05, remaining()))
+
+    async def run(self):
+        """ Runs the heartbeat alongside the reconnect supervisor on the running loop until stop() is called. """
+        load_transport_modules()
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        self.outbox_wakeup = asyncio.Event()
+        if self.stop_event.is_set():
+            self.stopping.set()
+        self.supervisor = ReconnectSupervisor(self)
+        heartbeat_task = None
+        try:
+            if not self.opened:
+                # The broker connection opens while local state (outbox, dedup index, token) loads from disk
+                self.supervisor.prewarm()
+                try:
+                    await self.loop.run_in_executor(io_executor, self.open)
+                except (OSError, ValueError, sqlite3.Error) as e:
+                    # Retrying won't help with an unwritable directory or a corrupt file; say so and stop
+                    print(f"Could not load local state: {e!r}")
+                    self.open_error = e
+                    self.update_status(f"Could not load local state: {e}")
+                    return
+            heartbeat_task = asyncio.ensure_future(self.heartbeat_loop())
+            await self.supervisor.run()
+        finally:
+            if heartbeat_task is not None:
+                heartbeat_task.cancel()
+            if self.supervisor.session is not None:
+                # Shut down while pairing or backing off: close a prewarmed session that was never consumed from
+                await self.supervisor.session.close()
+            self.loop = None
+
+    def run_transport(self):
+        """ Thread target: runs the transport on a loop of its own until the client shuts down. """
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.run())
+        finally:
+            # Let cancelled helpers (heartbeat, outbox waits) unwind before the loop is closed
+            leftover = asyncio.all_tasks(loop)
+            for task in leftover:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*leftover, return_exceptions=True))
+            loop.close()
+
+    def start(self):
+        """ Starts the transport thread: loading local state, consuming, publishing, heartbeat and pairing. """
+        notifier_codecs.check_configuration()
+        self.thread = threading.Thread(target=self.run_transport, daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=2):
+        """ Stops the transport within timeout seconds, waiting for its thread if start() was used.
+
+        While consuming, the consumer is cancelled first and queued statuses are flushed until shortly before then.
+        """
+        self.stop_deadline = time.monotonic() + timeout
+        self.stop_event.set()
+        loop = self.loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self.stopping.set)
+            except RuntimeError:
+                pass  # Loop already closed
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout=max(0, self.stop_deadline - time.monotonic()) + 0.5)
+
+    def shutdown(self, deadline=SHUTDOWN_DEADLINE_SECONDS):
+        """ Graceful shutdown bounded by deadline seconds: stop consuming, flush statuses, close, sign out.
+
+        Safe to call more than once (only the first call does anything) and from any thread but the transport's.
+        """
+        with self.shutdown_lock:
+            if self.shut_down:
+                return
+            self.shut_down = True
+            self.shutdown_ends_at = ends_at = time.monotonic() + deadline
+        print(f"Shutting down (deadline {deadline:.1f}s)...")
+        self.stop(max(0, deadline - min(SHUTDOWN_SIGN_OUT_SECONDS, deadline / 2)))
+        # On a daemon thread so a slow backend can't hold the process past the deadline
+        signing_out = threading.Thread(target=self.send_sign_out, name='notifier-sign-out', daemon=True)
+        signing_out.start()
+        signing_out.join(max(0, ends_at - time.monotonic()))
+        if signing_out.is_alive():
+            print("Sign out did not finish before the shutdown deadline")
+
+    def exit_process(self, code=0):
+        """ Shuts down if that has not happened yet and ends the process with code, by the shutdown deadline.
+
+        The interpreter waits for I/O executor threads on exit, so a pairing, heartbeat, forward or attachment
+        download still blocked on the network then is abandoned instead.
+        """
+        self.shutdown()
+        io_executor.shutdown(wait=False, cancel_futures=True)
+        io_threads = [thread for thread in threading.enumerate() if thread.name.startswith('notifier-io')]
+        for thread in io_threads:
+            thread.join(max(0, self.shutdown_ends_at - time.monotonic()))
+        if any(thread.is_alive() for thread in io_threads):
+            print("Abandoning network calls still running at the shutdown deadline")
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+        sys.exit(code)
+
+
+def main():
+    """ Headless mode: no display needed; notifications are logged, or forwarded if NOTIFIER_FORWARD_URL is set. """
+    sink = ForwardingSink(NOTIFIER_FORWARD_URL) if NOTIFIER_FORWARD_URL else LoggingSink()
+    core = NotifierCore(sink)
+    stopped = threading.Event()
+    notifier_metrics.start_exporters(core.stop_event)
+    # Only the transport thread does any work in headless mode
+    notifier_profiling.install({'transport': core.call_on_transport})
+    # docker stop sends SIGTERM; treat it like Ctrl+C
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    core.start()
+    try:
+        while not stopped.is_set() and core.thread.is_alive():
+            stopped.wait(1)
+    except KeyboardInterrupt:
+        pass
+    print("Exiting...")
+    core.shutdown()
+    if core.open_error is not None:
+        print("Exited: the client could not start.")
+        core.exit_process(1)
+    print("Exited gracefully.")
+    core.exit_process()
+
+
+if __name__ == '__main__':
+    main()
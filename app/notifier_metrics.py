@@ -0,0 +1,209 @@
+""" Process-wide metrics for the client hot paths.
+
+Counters and latency histograms are exposed as Prometheus text (and JSON) on a local HTTP port and/or written
+to a JSON file periodically, so slow terminals can be found across the fleet.
+"""
+import collections
+import json
+import os
+import socket
+import threading
+import time
+
+# Serve /metrics (Prometheus text) and /metrics.json on 127.0.0.1:METRICS_PORT; 0 disables the endpoint
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+# Write a JSON snapshot to METRICS_FILE every METRICS_FILE_INTERVAL seconds; unset disables the file
+METRICS_FILE = os.getenv('METRICS_FILE')
+METRICS_FILE_INTERVAL = float(os.getenv('METRICS_FILE_INTERVAL', '60'))
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+# Most recent samples kept per histogram for the percentiles in the JSON snapshot
+RECENT_SAMPLES = 1000
+
+COUNTERS = {
+    'notifier_messages_received_total': 'Notifications delivered by the broker, including duplicates',
+    'notifier_duplicates_dropped_total': 'Redelivered notifications dropped by the dedup index',
+    'notifier_expired_dropped_total': 'Notifications dropped unshown because they had expired',
+    'notifier_superseded_dropped_total': 'Queued notifications replaced by a newer one with the same collapse_key',
+    'notifier_publish_failures_total': 'Status or presence messages the broker did not accept',
+    'notifier_reconnects_total': 'Broker sessions lost while consuming',
+    'notifier_connect_failures_total': 'Failed attempts to open a broker session',
+    'notifier_ui_stalls_total': 'Times the Tk mainloop was blocked for longer than UI_STALL_THRESHOLD_MS',
+}
+HISTOGRAMS = {
+    'notifier_receipt_to_delivered_seconds': "Receipt of a notification to the broker confirming 'delivered'",
+    'notifier_receipt_to_shown_seconds': 'Receipt of a notification to its window being shown',
+    'notifier_urgent_receipt_to_shown_seconds': 'Receipt to window shown for notifications at URGENT_PRIORITY or above',
+    'notifier_shown_to_ack_seconds': 'Notification window shown to the notification being acknowledged',
+    'notifier_ui_lag_seconds': 'How late the Tk mainloop ran the watchdog probe',
+    'notifier_heartbeat_rtt_seconds': 'Round trip of a REST heartbeat or of a broker-confirmed presence message',
+}
+
+
+class Histogram:
+
+    def __init__(self):
+        self.bucket_counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.recent = collections.deque(maxlen=RECENT_SAMPLES)
+
+    def observe(self, value):
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.bucket_counts[index] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        self.recent.append(value)
+
+    def summary(self):
+        recent = sorted(self.recent)
+
+        def percentile(fraction):
+            return round(recent[min(len(recent) - 1, int(fraction * len(recent)))], 4) if recent else None
+
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 4),
+            'max': round(self.max, 4),
+            'p50': percentile(0.50),
+            'p90': percentile(0.90),
+            'p99': percentile(0.99),
+        }
+
+
+lock = threading.Lock()
+counters = {name: 0 for name in COUNTERS}
+histograms = {name: Histogram() for name in HISTOGRAMS}
+# Stage timings recorded by notifier_profiling spans: span name -> Histogram
+spans = {}
+
+
+def inc(name, amount=1):
+    with lock:
+        counters[name] += amount
+
+
+def observe(name, seconds):
+    with lock:
+        histograms[name].observe(seconds)
+
+
+def observe_span(name, seconds):
+    with lock:
+        histogram = spans.get(name)
+        if histogram is None:
+            histogram = spans[name] = Histogram()
+        histogram.observe(seconds)
+
+
+def snapshot():
+    with lock:
+        return {
+            'hostname': socket.gethostname(),
+            'timestamp': time.time(),
+            'counters': dict(counters),
+            'histograms': {name: histogram.summary() for name, histogram in histograms.items()},
+            'spans': {name: histogram.summary() for name, histogram in spans.items()},
+        }
+
+
+def render_prometheus():
+    lines = [
+        '# HELP notifier_info Terminal this client runs on',
+        '# TYPE notifier_info gauge',
+        f'notifier_info{{hostname="{socket.gethostname()}"}} 1',
+    ]
+    with lock:
+        for name, help_text in COUNTERS.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name} {counters[name]}')
+        for name, help_text in HISTOGRAMS.items():
+            histogram = histograms[name]
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS, histogram.bucket_counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{le="+Inf"}} {histogram.count}')
+            lines.append(f'{name}_sum {histogram.sum}')
+            lines.append(f'{name}_count {histogram.count}')
+        if spans:
+            lines.append('# HELP notifier_span_seconds Time spent in instrumented stages (PROFILE_SPANS=1)')
+            lines.append('# TYPE notifier_span_seconds histogram')
+        for span, histogram in spans.items():
+            cumulative = 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS, histogram.bucket_counts):
+                cumulative += bucket_count
+                lines.append(f'notifier_span_seconds_bucket{{span="{span}",le="{bound}"}} {cumulative}')
+            lines.append(f'notifier_span_seconds_bucket{{span="{span}",le="+Inf"}} {histogram.count}')
+            lines.append(f'notifier_span_seconds_sum{{span="{span}"}} {histogram.sum}')
+            lines.append(f'notifier_span_seconds_count{{span="{span}"}} {histogram.count}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_json_file(path):
+    temp_path = f"{path}.tmp"
+    try:
+        with open(temp_path, 'w') as f:
+            json.dump(snapshot(), f)
+        os.replace(temp_path, path)
+    except OSError as e:
+        print(f"Error writing metrics file: {e}")
+
+
+def json_file_loop(path, interval, stop_event):
+    while not stop_event.wait(interval):
+        write_json_file(path)
+    write_json_file(path)
+
+
+def start_exporters(stop_event):
+    """ Starts the HTTP endpoint and/or JSON file writer configured by METRICS_PORT and METRICS_FILE. """
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT)
+    if METRICS_FILE:
+        threading.Thread(target=json_file_loop, args=(METRICS_FILE, METRICS_FILE_INTERVAL, stop_event),
+                         name='notifier-metrics-file', daemon=True).start()
+
+
+def start_http_server(port):
+    # http.server is only imported when the endpoint is enabled; it is a noticeable part of startup otherwise
+    import http.server
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                body = render_prometheus().encode()
+                content_type = 'text/plain; version=0.0.4'
+            elif self.path == '/metrics.json':
+                body = json.dumps(snapshot()).encode()
+                content_type = 'application/json'
+            else:
+                self.send_response(404)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Scrapes are not worth a log line each
+
+    try:
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+    except OSError as e:
+        print(f"Could not serve metrics on port {port}: {e}")
+        return
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='notifier-metrics', daemon=True).start()
+    print(f"Serving metrics on http://127.0.0.1:{port}/metrics")
@@ -0,0 +1,147 @@
+""" Opt-in profiling: timing spans around the notification hot path and on-demand cProfile/tracemalloc captures.
+
+Spans are recorded as notifier_span_seconds in notifier_metrics when PROFILE_SPANS is set; otherwise the wrapped
+functions are left untouched. A capture is started and stopped by PROFILE_SIGNAL (SIGUSR1, or SIGBREAK on
+Windows) or runs for PROFILE_CAPTURE_SECONDS from startup, and writes its files to PROFILE_DIR.
+"""
+import contextlib
+import cProfile
+import functools
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+
+import notifier_metrics
+
+# Time the instrumented stages (on_notification_received, decode, send_status_update, show_notification, ...)
+PROFILE_SPANS = os.getenv('PROFILE_SPANS', '0') == '1'
+# If set, profile the first PROFILE_CAPTURE_SECONDS after startup
+PROFILE_CAPTURE_SECONDS = float(os.getenv('PROFILE_CAPTURE_SECONDS', '0'))
+# Where captures are written (a profiles folder next to the token file by default)
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(
+    os.path.dirname(os.getenv('TOKEN_FILE_PATH', 'app/terminal_token.json')), 'profiles'))
+# Stack frames kept per allocation by tracemalloc during a capture
+PROFILE_TRACEMALLOC_FRAMES = int(os.getenv('PROFILE_TRACEMALLOC_FRAMES', '10'))
+# Signal that starts a capture, and stops and writes it when sent again
+PROFILE_SIGNAL = getattr(signal, 'SIGUSR1', None) or getattr(signal, 'SIGBREAK', None)
+
+# Before Python 3.12 a cProfile.Profile only sees the thread it was enabled on, so each target gets its own. From
+# 3.12 it is built on sys.monitoring: one profiler sees every thread, and enabling a second one raises ValueError.
+PROFILE_PER_THREAD = sys.version_info < (3, 12)
+
+# No-op context used for spans while PROFILE_SPANS is off
+NO_SPAN = contextlib.nullcontext()
+
+# Running capture: {'started': time.time(), 'profiles': {target name (or 'all'): cProfile.Profile}}, or None
+capture = None
+capture_lock = threading.Lock()
+# Target name -> function that runs a callable on that target's thread; cProfile only sees the thread that enabled it
+capture_targets = {}
+
+
+def span(name):
+    """ Decorator recording each call of the function as span name; a no-op unless PROFILE_SPANS is set. """
+    def decorate(func):
+        if not PROFILE_SPANS:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                notifier_metrics.observe_span(name, time.perf_counter() - started)
+        return wrapper
+    return decorate
+
+
+@contextlib.contextmanager
+def _timed(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        notifier_metrics.observe_span(name, time.perf_counter() - started)
+
+
+def timed(name):
+    """ Context manager version of span for a few lines inside a function. """
+    return _timed(name) if PROFILE_SPANS else NO_SPAN
+
+
+def start_capture():
+    global capture
+    with capture_lock:
+        if capture is not None:
+            return
+        capture = {'started': time.time(), 'profiles': {}}
+        profiles = capture['profiles']
+    tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+    if not PROFILE_PER_THREAD:
+        profile = cProfile.Profile()
+        profiles['all'] = profile
+        profile.enable()
+        print("Profiling capture started (all threads)")
+        return
+    for name, run_on_thread in capture_targets.items():
+        profile = cProfile.Profile()
+        profiles[name] = profile
+        run_on_thread(profile.enable)
+    print(f"Profiling capture started ({', '.join(capture_targets) or 'allocations only'})")
+
+
+def stop_capture():
+    global capture
+    with capture_lock:
+        if capture is None:
+            return
+        running, capture = capture, None
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    prefix = os.path.join(PROFILE_DIR, time.strftime('capture-%Y%m%d-%H%M%S', time.localtime(running['started'])))
+
+    for name, profile in running['profiles'].items():
+        finish = functools.partial(finish_profile, profile, f'{prefix}-{name}.prof')
+        if name in capture_targets:
+            capture_targets[name](finish)
+        else:
+            finish()
+
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    snapshot.dump(f'{prefix}.tracemalloc')
+    with open(f'{prefix}-allocations.txt', 'w', encoding='utf-8') as f:
+        for stat in snapshot.statistics('lineno')[:50]:
+            f.write(f'{stat}\n')
+    print(f"Profiling capture written to {prefix}*")
+
+
+def finish_profile(profile, path):
+    # Must run on the thread the profile was enabled on (any thread from Python 3.12)
+    profile.disable()
+    try:
+        profile.dump_stats(path)
+    except OSError as e:
+        print(f"Error writing profile {path}: {e}")
+
+
+def toggle_capture(*args):
+    if capture is None:
+        start_capture()
+    else:
+        stop_capture()
+
+
+def install(targets):
+    """ Registers the threads to profile (name -> run_on_thread) and the signal/startup triggers. """
+    capture_targets.update(targets)
+    if PROFILE_SIGNAL is not None and threading.current_thread() is threading.main_thread():
+        signal.signal(PROFILE_SIGNAL, toggle_capture)
+    if PROFILE_CAPTURE_SECONDS > 0:
+        start_capture()
+        timer = threading.Timer(PROFILE_CAPTURE_SECONDS, stop_capture)
+        timer.daemon = True
+        timer.start()
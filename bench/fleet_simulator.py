@@ -0,0 +1,423 @@
+""" Fleet simulator: many simulated terminals against a local RabbitMQ and a stub backend.
+
+Each terminal is a NotifierCore from app/notifier_core.py (the same pairing, consuming and status code that
+app_v2.py runs), all sharing one asyncio loop in this process. The stub backend runs in a process of its own, so
+its work doesn't count as client CPU and memory: it serves /pair/, /terminal_heartbeat/ and /terminal_sign_out/,
+publishes notifications round-robin to the terminals and consumes their statuses from notifications_responses.
+Reports publish->delivered (also for urgent notifications alone) and delivered->read latency percentiles, broker
+connection counts, and client CPU and memory use.
+
+    python bench/fleet_simulator.py --terminals 1000 --rate 10000 --duration 60
+
+Broker settings come from the usual RABBITMQ_* environment variables.
+"""
+import argparse
+import asyncio
+import collections
+import contextlib
+import http.server
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import threading
+import time
+
+import pika
+import requests
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+# Queue the simulated backend reads terminal statuses from
+BENCH_RESPONSES_QUEUE = 'bench_responses'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--terminals', type=int, default=100, help='simulated terminals (default 100)')
+    parser.add_argument('--rate', type=int, default=1000, help='notifications published per minute (default 1000)')
+    parser.add_argument('--duration', type=float, default=60, help='seconds to publish for (default 60)')
+    parser.add_argument('--read-delay', type=float, default=1.0,
+                        help='seconds a simulated user takes to acknowledge a notification (default 1.0)')
+    parser.add_argument('--content-size', type=int, default=200, help='notification_content length (default 200)')
+    parser.add_argument('--audience', choices=('direct', 'broadcast', 'group'), default='direct',
+                        help='publish each notification to one terminal, once to all of them, or once to a group')
+    parser.add_argument('--groups', type=int, default=10,
+                        help='with --audience group, terminals are split round-robin into this many groups')
+    parser.add_argument('--urgent-every', type=int, default=0,
+                        help='publish every Nth notification with AMQP priority 9 and report its latency separately')
+    parser.add_argument('--format', choices=('json', 'msgpack'), default='json',
+                        help='content type the backend publishes notifications in (default json)')
+    parser.add_argument('--compression', choices=('none', 'zlib', 'zstd'), default='none',
+                        help='compression of notifications above COMPRESSION_MIN_BYTES (default none)')
+    parser.add_argument('--api-port', type=int, default=8000, help='port of the stub backend (default 8000)')
+    parser.add_argument('--management-url', default=None,
+                        help='RabbitMQ management API, e.g. http://localhost:15672, to report broker connections')
+    parser.add_argument('--ramp-timeout', type=float, default=120,
+                        help='seconds to wait for every terminal to be consuming (default 120)')
+    parser.add_argument('--json', default=None, help='also write the report to this file')
+    parser.add_argument('--verbose', action='store_true', help='keep the per-terminal client logging')
+    return parser.parse_args()
+
+
+class StubBackend(http.server.BaseHTTPRequestHandler):
+    """ Hands out one token per hostname and accepts heartbeats and sign-outs.
+
+    With groups set, pairing also assigns the n-th terminal to group line.<n % groups>.
+    """
+
+    tokens = {}
+    groups = 0
+    counter = itertools.count(1)
+    lock = threading.Lock()
+    requests_seen = {'/pair/': 0, '/terminal_heartbeat/': 0, '/terminal_sign_out/': 0}
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        fields = dict(item.split('=', 1) for item in self.rfile.read(length).decode().split('&') if '=' in item)
+        if self.path not in self.requests_seen:
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = b'{}'
+        with self.lock:
+            self.requests_seen[self.path] += 1
+            if self.path == '/pair/':
+                hostname = fields.get('hostname', '')
+                token = self.tokens.setdefault(hostname, f'bench{next(self.counter)}')
+                paired = {'token': token}
+                if self.groups:
+                    paired['groups'] = [f'line.{int(token[len("bench"):]) % self.groups}']
+                body = json.dumps(paired).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubBackendServer(http.server.ThreadingHTTPServer):
+    # A whole fleet pairs at once; the default listen backlog of 5 would drop connections into TCP retransmits
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def start_stub_backend(port):
+    server = StubBackendServer(('127.0.0.1', port), StubBackend)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class Recorder:
+    """ Timestamps (time.time()) of every notification the backend published and every status it got back.
+
+    Statuses are keyed by (notification_id, token); token is None for direct notifications, whose statuses don't
+    carry it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.published = {}
+        # Ids of the notifications published with a high priority
+        self.urgent = set()
+        # Deliveries the published notifications should produce, one per receiving terminal
+        self.expected = 0
+        self.delivered = {}
+        self.read = {}
+        self.status_messages = 0
+        self.notification_bytes = 0
+
+    def on_status(self, status):
+        now = time.time()
+        key = (status.get('notification_id'), status.get('token'))
+        with self.lock:
+            if status.get('status') == 'delivered':
+                self.delivered.setdefault(key, now)
+            elif status.get('status') in ('read', 'replied'):
+                self.read.setdefault(key, now)
+
+
+def consume_responses(recorder, ready, stop):
+    """ Plays the server side of notifications_responses; single and batched statuses are both understood. """
+    import notifier_core
+    import notifier_codecs
+
+    connection = pika.BlockingConnection(notifier_core.get_connection_parameters())
+    channel = connection.channel()
+    channel.exchange_declare(exchange=notifier_core.RESPONSES_EXCHANGE, exchange_type='direct', durable=True)
+    channel.queue_declare(queue=BENCH_RESPONSES_QUEUE, auto_delete=True)
+    channel.queue_purge(queue=BENCH_RESPONSES_QUEUE)
+    channel.queue_bind(queue=BENCH_RESPONSES_QUEUE, exchange=notifier_core.RESPONSES_EXCHANGE,
+                       routing_key=notifier_core.RESPONSES_ROUTING_KEY)
+
+    def on_message(ch, method, properties, body):
+        message = notifier_codecs.decode(body, properties.content_type, properties.content_encoding)
+        recorder.status_messages += 1
+        for status in message.get('statuses', [message]):
+            recorder.on_status(status)
+
+    channel.basic_consume(queue=BENCH_RESPONSES_QUEUE, on_message_callback=on_message, auto_ack=True)
+    ready.set()
+    while not stop.is_set():
+        connection.process_data_events(time_limit=0.2)
+    connection.close()
+
+
+def publish_notifications(recorder, audiences, args):
+    """ Publishes args.rate notifications per minute for args.duration seconds, round-robin over audiences.
+
+    audiences is a list of (exchange, routing_key, number of terminals reached).
+    """
+    import notifier_core
+    import notifier_codecs
+
+    connection = pika.BlockingConnection(notifier_core.get_connection_parameters())
+    channel = connection.channel()
+    channel.exchange_declare(exchange='notifications', exchange_type='direct', durable=True)
+    # Repetitive but not uniform, roughly like real announcement text
+    words = ('Obvestilo', 'linija', 'izmena', 'vzdrževanje', 'oddelek', 'sestanek', 'ob', '14:00', 'jutri')
+    content = ' '.join(itertools.islice(itertools.cycle(words), args.content_size // 6 + 1))[:args.content_size]
+    interval = 60.0 / args.rate
+    started = time.monotonic()
+    for notification_id, (exchange, routing_key, reach) in zip(itertools.count(1), itertools.cycle(audiences)):
+        due = started + (notification_id - 1) * interval
+        if due - started >= args.duration:
+            break
+        delay = due - time.monotonic()
+        if delay > 0:
+            connection.sleep(delay)
+        message = {'notification_id': notification_id, 'sender_user': 'bench', 'notification_content': content}
+        body, content_type, content_encoding = notifier_codecs.encode(message, args.format, args.compression)
+        urgent = args.urgent_every > 0 and notification_id % args.urgent_every == 0
+        with recorder.lock:
+            recorder.published[notification_id] = time.time()
+            recorder.notification_bytes += len(body)
+            recorder.expected += reach
+            if urgent:
+                recorder.urgent.add(notification_id)
+        channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body,
+                              properties=pika.BasicProperties(content_type=content_type,
+                                                              content_encoding=content_encoding,
+                                                              priority=9 if urgent else None))
+    connection.close()
+
+
+def percentiles(samples):
+    if not samples:
+        return None
+    samples = sorted(samples)
+
+    def pick(fraction):
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))] * 1000
+
+    return {
+        'count': len(samples),
+        'p50_ms': round(pick(0.50), 1),
+        'p90_ms': round(pick(0.90), 1),
+        'p99_ms': round(pick(0.99), 1),
+        'max_ms': round(samples[-1] * 1000, 1),
+    }
+
+
+def run_backend(args, conn):
+    """ Backend process: stub HTTP API, notification publisher and status consumer.
+
+    Talks to the fleet process over conn: sends 'ready' once it serves requests, receives the audiences to publish
+    to, sends 'drained' once the statuses are in (or the drain timed out), and after being told the fleet has
+    stopped sends its results.
+    """
+    sys.path.insert(0, APP_DIR)
+    if args.audience == 'group':
+        StubBackend.groups = args.groups
+    start_stub_backend(args.api_port)
+    recorder = Recorder()
+    stop_responses = threading.Event()
+    responses_ready = threading.Event()
+    responses_thread = threading.Thread(target=consume_responses,
+                                        args=(recorder, responses_ready, stop_responses), daemon=True)
+    responses_thread.start()
+    responses_ready.wait(10)
+    conn.send('ready')
+
+    publish_notifications(recorder, conn.recv(), args)
+    # Give the last notifications time to be delivered, read and confirmed
+    drain_deadline = time.monotonic() + args.read_delay + 10
+    while len(recorder.read) < recorder.expected and time.monotonic() < drain_deadline:
+        time.sleep(0.2)
+    conn.send('drained')
+
+    # Keep serving until the terminals have signed out
+    conn.recv()
+    stop_responses.set()
+    responses_thread.join(timeout=5)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    with recorder.lock:
+        delivered = [at - recorder.published[key[0]]
+                     for key, at in recorder.delivered.items() if key[0] in recorder.published]
+        urgent_delivered = [at - recorder.published[key[0]]
+                            for key, at in recorder.delivered.items() if key[0] in recorder.urgent]
+        read = [at - recorder.delivered[key] for key, at in recorder.read.items() if key in recorder.delivered]
+        conn.send({
+            'notifications_published': len(recorder.published),
+            'deliveries_expected': recorder.expected,
+            'notifications_delivered': len(delivered),
+            'notifications_read': len(read),
+            'notification_bytes_published': recorder.notification_bytes,
+            'status_messages': recorder.status_messages,
+            'publish_to_delivered': percentiles(delivered),
+            'urgent_publish_to_delivered': percentiles(urgent_delivered),
+            'delivered_to_read': percentiles(read),
+            'backend_requests': dict(StubBackend.requests_seen),
+            'backend_cpu_seconds': round(usage.ru_utime + usage.ru_stime, 2),
+        })
+
+
+def broker_connections(management_url):
+    if not management_url:
+        return None
+    import notifier_core
+
+    try:
+        response = requests.get(f'{management_url.rstrip("/")}/api/overview', timeout=5,
+                                auth=(notifier_core.RABBITMQ_USERNAME, notifier_core.RABBITMQ_PASSWORD))
+        response.raise_for_status()
+        return response.json().get('object_totals', {}).get('connections')
+    except requests.RequestException as e:
+        print(f"Could not read broker connections from the management API: {e}")
+        return None
+
+
+def main():
+    args = parse_args()
+    # Point the client core at the stub backend before its configuration is read at import
+    os.environ['API_BASE_URL'] = f'http://localhost:{args.api_port}'
+    os.environ.setdefault('IO_WORKERS', '16')
+    # Time the client stages (decode, on_notification_received, ...) for the report
+    os.environ.setdefault('PROFILE_SPANS', '1')
+    sys.path.insert(0, APP_DIR)
+    import notifier_core
+    import notifier_metrics
+
+    # The stub backend is local, so don't look the external IP up on ipify for every pairing
+    notifier_core.cached_external_ip = ('127.0.0.1', time.monotonic())
+    backend_conn, child_conn = multiprocessing.Pipe()
+    backend = multiprocessing.Process(target=run_backend, args=(args, child_conn), daemon=True)
+    backend.start()
+    if not backend_conn.poll(30):
+        sys.exit("The stub backend did not start")
+    backend_conn.recv()
+
+    loop = asyncio.new_event_loop()
+
+    class SimulatedUser(notifier_core.NotificationSink):
+        """ Acknowledges every notification read_delay seconds after it was handed over, as 'read'. """
+
+        def __init__(self):
+            self.core = None
+
+        def notify(self, notification):
+            loop.call_later(args.read_delay, self.core.send_response, notification['notification_id'], None, 'read',
+                            notification['channel'])
+
+    cores = []
+    for index in range(args.terminals):
+        sink = SimulatedUser()
+        core = notifier_core.NotifierCore(sink, hostname=f'sim-terminal-{index}', token_file_path=None,
+                                          outbox_path=':memory:', dedup_file_path=None)
+        sink.core = core
+        core.open()
+        cores.append(core)
+
+    def run_fleet():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(asyncio.gather(*(core.run() for core in cores), return_exceptions=True))
+        # Let cancelled helpers (heartbeats, outbox waits) unwind before the loop is closed
+        leftover = asyncio.all_tasks(loop)
+        for task in leftover:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*leftover, return_exceptions=True))
+        loop.close()
+
+    cpu_before = resource.getrusage(resource.RUSAGE_SELF)
+    wall_before = time.monotonic()
+    client_log = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+    with client_log:
+        fleet_thread = threading.Thread(target=run_fleet, daemon=True)
+        fleet_thread.start()
+
+        def consuming():
+            return sum(1 for core in cores
+                       if core.supervisor is not None and core.supervisor.state == core.supervisor.CONSUMING)
+
+        deadline = time.monotonic() + args.ramp_timeout
+        while consuming() < len(cores) and time.monotonic() < deadline:
+            time.sleep(0.2)
+        ramp_seconds = time.monotonic() - wall_before
+        ready_terminals = consuming()
+
+        peak_connections = broker_connections(args.management_url)
+        client_connections = sum(1 for core in cores if core.supervisor is not None
+                                 and core.supervisor.session is not None
+                                 and core.supervisor.session.connection.is_open)
+        tokens = [core.token for core in cores if core.token is not None]
+        if args.audience == 'broadcast':
+            audiences = [(notifier_core.BROADCAST_EXCHANGE, '', len(tokens))]
+        elif args.audience == 'group':
+            members = collections.Counter(group for core in cores if core.token is not None
+                                          for group in core.paired_groups)
+            audiences = [(notifier_core.GROUP_EXCHANGE, group, count) for group, count in sorted(members.items())]
+        else:
+            audiences = [('notifications', token, 1) for token in tokens]
+        backend_conn.send(audiences)
+        backend_conn.recv()
+
+        for core in cores:
+            core.stop()
+        fleet_thread.join(timeout=30)
+    # The backend runs in its own process, so this is the fleet alone
+    cpu_after = resource.getrusage(resource.RUSAGE_SELF)
+    wall_seconds = time.monotonic() - wall_before
+    backend_conn.send('stop')
+    results = backend_conn.recv()
+    backend.join(timeout=10)
+
+    cpu_seconds = (cpu_after.ru_utime - cpu_before.ru_utime) + (cpu_after.ru_stime - cpu_before.ru_stime)
+    report = {
+        'terminals': args.terminals,
+        'terminals_consuming': ready_terminals,
+        'ramp_up_seconds': round(ramp_seconds, 2),
+        'notifications_published': results['notifications_published'],
+        'audience': args.audience,
+        'deliveries_expected': results['deliveries_expected'],
+        'notifications_delivered': results['notifications_delivered'],
+        'notifications_read': results['notifications_read'],
+        'notification_bytes_published': results['notification_bytes_published'],
+        'status_messages': results['status_messages'],
+        'publish_to_delivered': results['publish_to_delivered'],
+        'urgent_publish_to_delivered': results['urgent_publish_to_delivered'],
+        'delivered_to_read': results['delivered_to_read'],
+        # As reported by the management API (includes the two backend connections), and as seen by the clients
+        'broker_connections': peak_connections,
+        'client_connections': client_connections,
+        'backend_requests': results['backend_requests'],
+        'client_cpu_seconds': round(cpu_seconds, 2),
+        'client_cpu_percent': round(100 * cpu_seconds / wall_seconds, 1),
+        # ru_maxrss is in kilobytes on Linux
+        'client_max_rss_mb': round(cpu_after.ru_maxrss / 1024, 1),
+        'backend_cpu_seconds': results['backend_cpu_seconds'],
+        # Counters and latency histograms of all simulated terminals together (see app/notifier_metrics.py)
+        'client_metrics': {key: value for key, value in notifier_metrics.snapshot().items()
+                           if key in ('counters', 'histograms', 'spans')},
+    }
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
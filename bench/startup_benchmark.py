@@ -0,0 +1,122 @@
+""" Startup benchmark: time from process start to the client listening for notifications.
+
+Starts the client repeatedly against a local RabbitMQ and the fleet simulator's stub backend, and reports how long
+importing the client takes and how long until it prints that it is listening, with a saved token (the usual
+morning logon) or pairing first.
+
+    python bench/startup_benchmark.py --runs 10
+    python bench/startup_benchmark.py --client app/app_v2.py --unpaired
+
+Broker settings come from the usual RABBITMQ_* environment variables.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from fleet_simulator import start_stub_backend
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+# Printed by the client once its consumer is registered
+LISTENING_MARKER = 'Listening for notifications on queue'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=10, help='client starts to time (default 10)')
+    parser.add_argument('--client', default='app/notifier_core.py',
+                        help='client script; app/app_v2.py needs a display (default app/notifier_core.py)')
+    parser.add_argument('--unpaired', action='store_true', help='start without a saved token, so it pairs first')
+    parser.add_argument('--api-port', type=int, default=8000, help='port of the stub backend (default 8000)')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for each start (default 30)')
+    parser.add_argument('--json', default=None, help='also write the report to this file')
+    return parser.parse_args()
+
+
+def client_env(workdir, api_port):
+    env = dict(os.environ)
+    env.update({
+        'API_BASE_URL': f'http://localhost:{api_port}',
+        'TOKEN_FILE_PATH': os.path.join(workdir, 'terminal_token.json'),
+        'PYTHONUNBUFFERED': '1',
+    })
+    return env
+
+
+def time_import(module, env):
+    code = f'import time; started = time.perf_counter(); import {module}; print(time.perf_counter() - started)'
+    result = subprocess.run([sys.executable, '-c', code], cwd=os.path.join(REPO_DIR, 'app'), env=env,
+                            capture_output=True, text=True)
+    return float(result.stdout.strip()) if result.returncode == 0 else None
+
+
+def time_to_listening(client, env, timeout):
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, client], cwd=REPO_DIR, env=env, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT, text=True)
+    timer = threading.Timer(timeout, process.kill)
+    timer.start()
+    elapsed = None
+    try:
+        for line in process.stdout:
+            if LISTENING_MARKER in line:
+                elapsed = time.perf_counter() - started
+                break
+    finally:
+        timer.cancel()
+        process.terminate()
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    return elapsed
+
+
+def summarize(samples):
+    samples = [sample * 1000 for sample in samples if sample is not None]
+    if not samples:
+        return None
+    return {
+        'count': len(samples),
+        'min_ms': round(min(samples), 1),
+        'median_ms': round(statistics.median(samples), 1),
+        'max_ms': round(max(samples), 1),
+    }
+
+
+def main():
+    args = parse_args()
+    start_stub_backend(args.api_port)
+    module = os.path.splitext(os.path.basename(args.client))[0]
+    imports = []
+    listening = []
+    for run in range(args.runs):
+        with tempfile.TemporaryDirectory() as workdir:
+            env = client_env(workdir, args.api_port)
+            if not args.unpaired:
+                with open(env['TOKEN_FILE_PATH'], 'w') as f:
+                    json.dump({'token': 'bench-startup'}, f)
+            imports.append(time_import(module, env))
+            elapsed = time_to_listening(args.client, env, args.timeout)
+            listening.append(elapsed)
+            print(f"Run {run + 1}: listening after {elapsed * 1000:.0f} ms" if elapsed is not None
+                  else f"Run {run + 1}: not listening within {args.timeout:.0f} s")
+    report = {
+        'client': args.client,
+        'paired': not args.unpaired,
+        'import': summarize(imports),
+        'time_to_listening': summarize(listening),
+    }
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
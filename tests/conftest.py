@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The client modules import each other as top-level modules, the way app/app_v2.py is run
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
@@ -0,0 +1,136 @@
+import collections
+import time
+
+import pytest
+
+tk = pytest.importorskip('tkinter')
+
+import app_v2  # noqa: E402
+from app_v2 import wrap_lines  # noqa: E402
+
+
+def wrapped(text, width, limit=100):
+    lines, position = wrap_lines(text, 0, width, limit)
+    return [text[start:end] for start, end in lines], position
+
+
+def test_wrap_breaks_at_spaces():
+    assert wrapped("one two three four", 9) == (["one two", "three", "four"], 18)
+
+
+def test_wrap_breaks_long_words():
+    assert wrapped("abcdefghij", 4) == (["abcd", "efgh", "ij"], 10)
+
+
+def test_wrap_keeps_newlines():
+    assert wrapped("a\n\nb", 10) == (["a", "", "b"], 4)
+
+
+def test_wrap_continues_from_position():
+    text = "one two three four"
+    lines, position = wrap_lines(text, 0, 9, 1)
+    assert (lines, position) == ([(0, 7)], 8)
+    assert wrap_lines(text, position, 9, 1) == ([(8, 13)], 14)
+
+
+class FakeNotifier:
+
+    def __init__(self):
+        self.statuses = []
+
+    def send_status_update(self, notification_id, status, on_confirmed=None, channel='direct'):
+        self.statuses.append((notification_id, status))
+
+
+@pytest.fixture
+def pending(monkeypatch):
+    pending = collections.deque()
+    monkeypatch.setattr(app_v2, 'pending_notifications', pending)
+    monkeypatch.setattr(app_v2, 'notifier', FakeNotifier())
+    return pending
+
+
+def notification(notification_id, priority=0, collapse_key=None, sent_at=None, expires_at=None):
+    return {'notification_id': notification_id, 'priority': priority, 'collapse_key': collapse_key,
+            'sent_at': sent_at, 'expires_at': expires_at, 'channel': 'direct'}
+
+
+def test_schedule_by_priority(pending):
+    for n in (notification(1), notification(2), notification(3, priority=3), notification(4, priority=3)):
+        app_v2.schedule_notification(n)
+    # The notification on screen stays first
+    assert [n['notification_id'] for n in pending] == [1, 3, 4, 2]
+
+
+def test_urgent_notification_preempts(pending):
+    app_v2.schedule_notification(notification(1, priority=1))
+    position = app_v2.schedule_notification(notification(2, priority=app_v2.URGENT_PRIORITY))
+    assert position == 0
+    assert [n['notification_id'] for n in pending] == [2, 1]
+
+
+def test_collapse_key_lookup(pending):
+    pending.extend([notification(1, collapse_key='a'), notification(2, collapse_key='b')])
+    assert app_v2.find_collapsed('b') == 1
+    assert app_v2.find_collapsed('c') is None
+    assert app_v2.find_collapsed(None) is None
+
+
+def test_is_newer():
+    assert app_v2.is_newer(notification(2, sent_at=20), notification(1, sent_at=10))
+    assert not app_v2.is_newer(notification(2, sent_at=5), notification(1, sent_at=10))
+    # Without send times the later arrival wins
+    assert app_v2.is_newer(notification(2), notification(1, sent_at=10))
+
+
+def test_expired_notifications_are_dropped(pending):
+    now = time.time()
+    pending.extend([notification(1, expires_at=now - 1), notification(2, expires_at=now + 60), notification(3)])
+    app_v2.drop_expired_notifications()
+    assert [n['notification_id'] for n in pending] == [2, 3]
+    assert app_v2.notifier.statuses == [(1, 'expired')]
+
+
+@pytest.fixture
+def tk_root():
+    try:
+        root = tk.Tk()
+    except tk.TclError:
+        pytest.skip("no display")
+    root.geometry("400x200")
+    yield root
+    root.destroy()
+
+
+def test_virtual_view_wraps_only_what_is_shown(tk_root):
+    view = app_v2.VirtualTextView(tk_root, ("Helvetica", 12), "white")
+    view.frame.pack(fill="both", expand=True)
+    tk_root.update()
+    text = "word " * 200000
+    view.set_text(text)
+    assert len(view.lines) <= view.visible_rows() + 1
+    assert view.wrapped_to < len(text)
+    view.yview("moveto", 0.5)
+    assert view.top > 0
+    view.ensure_wrapped(view.top + view.visible_rows())
+    start, end = view.lines[view.top]
+    assert text[start:end].strip().startswith("word")
+
+
+@pytest.mark.parametrize('name, openable', [
+    ('plan.pdf', True), ('Slika.JPG', True), ('report.xlsx', True),
+    ('setup.exe', False), ('run.bat', False), ('link.lnk', False), ('app.hta', False), ('noextension', False),
+])
+def test_only_documents_and_images_are_openable(name, openable):
+    attachment = {'path': '/attachments/1/', 'name': name, 'size': None, 'content_type': None}
+    assert app_v2.is_openable_attachment(attachment) is openable
+
+
+def test_open_file_refuses_programs(monkeypatch):
+    import webbrowser
+    opened = []
+    monkeypatch.setattr(webbrowser, 'open', opened.append)
+    app_v2.open_file('/cache/abc.exe')
+    assert opened == []
+    app_v2.open_file('/cache/abc.pdf')
+    assert opened == ['file:///cache/abc.pdf']
@@ -0,0 +1,85 @@
+import io
+import zlib
+
+import pytest
+
+import notifier_codecs
+
+
+MESSAGE = {'notification_id': 1, 'sender_user': 'u', 'notification_content': 'č' * 2000}
+
+
+@pytest.mark.parametrize('content_type', ['json', 'msgpack'])
+@pytest.mark.parametrize('compression', ['none', 'zlib', 'zstd'])
+def test_round_trip(content_type, compression):
+    if content_type == 'msgpack':
+        pytest.importorskip('msgpack')
+    if compression == 'zstd':
+        pytest.importorskip('zstandard')
+    body, mime_type, encoding = notifier_codecs.encode(MESSAGE, content_type, compression)
+    assert encoding == (None if compression == 'none' else compression)
+    assert notifier_codecs.decode(body, mime_type, encoding) == MESSAGE
+
+
+def test_small_messages_are_not_compressed():
+    body, mime_type, encoding = notifier_codecs.encode({'notification_id': 1}, 'json', 'zlib')
+    assert (body, mime_type, encoding) == (b'{"notification_id":1}', 'application/json', None)
+
+
+def test_json_text_is_sent_as_is():
+    body, _, _ = notifier_codecs.encode(json_text='{"a": 1}', content_type='json', compression='none')
+    assert body == b'{"a": 1}'
+
+
+def test_plain_json_without_properties():
+    assert notifier_codecs.decode(b'{"notification_id": 1}') == {'notification_id': 1}
+
+
+def test_deflate_alias():
+    assert notifier_codecs.decode(zlib.compress(b'{"a": 1}'), None, 'deflate') == {'a': 1}
+
+
+@pytest.mark.parametrize('body, content_type, encoding', [
+    (b'not json', None, None),
+    (b'{"a": 1}', None, 'gzip'),
+    (b'garbage', None, 'zlib'),
+])
+def test_undecodable_bodies_raise_value_error(body, content_type, encoding):
+    with pytest.raises(ValueError):
+        notifier_codecs.decode(body, content_type, encoding)
+
+
+@pytest.mark.parametrize('body', [b'[1, 2]', b'"text"', b'42', b'null'])
+def test_bodies_that_are_not_objects_raise_value_error(body):
+    with pytest.raises(ValueError):
+        notifier_codecs.decode(body)
+
+
+def test_msgpack_scalar_raises_value_error():
+    msgpack = pytest.importorskip('msgpack')
+    with pytest.raises(ValueError):
+        notifier_codecs.decode(msgpack.packb(7), 'application/msgpack')
+
+
+def test_zstd_frame_without_content_size():
+    zstandard = pytest.importorskip('zstandard')
+    buffer = io.BytesIO()
+    with zstandard.ZstdCompressor().stream_writer(buffer, closefd=False) as writer:
+        writer.write(b'{"notification_id": 1}')
+    assert notifier_codecs.decode(buffer.getvalue(), None, 'zstd') == {'notification_id': 1}
+
+
+@pytest.mark.parametrize('encoding', ['zlib', 'zstd'])
+def test_body_expanding_past_limit_raises_value_error(encoding, monkeypatch):
+    if encoding == 'zstd':
+        pytest.importorskip('zstandard')
+    monkeypatch.setattr(notifier_codecs, 'MAX_DECOMPRESSED_BYTES', 1000)
+    body, _, _ = notifier_codecs.encode({'padding': ' ' * 5000}, 'json', encoding)
+    with pytest.raises(ValueError):
+        notifier_codecs.decode(body, None, encoding)
+
+
+def test_truncated_zlib_body_raises_value_error():
+    body = zlib.compress(b'{"notification_id": 1}')
+    with pytest.raises(ValueError):
+        notifier_codecs.decode(body[:-4], None, 'zlib')
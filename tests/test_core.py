@@ -0,0 +1,65 @@
+import asyncio
+import types
+
+import pytest
+
+import notifier_core
+from notifier_core import NotifierCore, NotificationSink
+
+
+class RecordingSink(NotificationSink):
+
+    def __init__(self):
+        self.statuses = []
+
+    def notify(self, notification):
+        pass
+
+    def status(self, text):
+        self.statuses.append(text)
+
+
+def make_core(tmp_path, sink, token_text=None):
+    token_file = tmp_path / 'token.json'
+    if token_text is not None:
+        token_file.write_text(token_text)
+    return NotifierCore(sink, hostname='terminal', token_file_path=str(token_file),
+                        outbox_path=str(tmp_path / 'outbox.sqlite3'), dedup_file_path=str(tmp_path / 'seen.txt'),
+                        attachment_cache_path=str(tmp_path / 'attachments'))
+
+
+def test_corrupt_token_file_stops_transport_and_is_reported(tmp_path, monkeypatch):
+    pytest.importorskip('pika')
+    # Nothing listens there; the prewarmed broker connection just fails
+    monkeypatch.setattr(notifier_core, 'RABBITMQ_PORT', 1)
+    sink = RecordingSink()
+    core = make_core(tmp_path, sink, token_text='{not json')
+    asyncio.run(asyncio.wait_for(core.run(), 10))
+    assert isinstance(core.open_error, ValueError)
+    assert not core.opened
+    assert sink.statuses[-1].startswith("Could not load local state")
+    core.outbox.close()
+
+
+def test_body_that_is_not_an_object_is_nacked(tmp_path, monkeypatch):
+    monkeypatch.setattr(notifier_core, 'CONSUMER_ACK_MODE', 'manual')
+    core = make_core(tmp_path, RecordingSink())
+    nacked = []
+    channel = types.SimpleNamespace(basic_nack=lambda delivery_tag, requeue: nacked.append((delivery_tag, requeue)))
+    method = types.SimpleNamespace(delivery_tag=5, exchange='notifications', routing_key='abc')
+    properties = types.SimpleNamespace(content_type=None, content_encoding=None, timestamp=None, expiration=None,
+                                       priority=None)
+    core.on_notification_received(channel, method, properties, b'[1, 2]')
+    assert nacked == [(5, False)]
+
+
+def test_forwarded_payload_leaves_out_internal_fields(monkeypatch):
+    posted = []
+    session = types.SimpleNamespace(post=lambda url, json, timeout: posted.append(json) or
+                                    types.SimpleNamespace(status_code=200))
+    monkeypatch.setattr(notifier_core, 'get_http_session', lambda: session)
+    notification = {'notification_id': 1, 'sender_user': 'u', 'content': 'c', 'attachments': [], 'priority': 0,
+                    'channel': 'direct', 'sent_at': None, 'expires_at': None, 'collapse_key': None,
+                    'received_at': 12.5}
+    notifier_core.ForwardingSink('http://forward.invalid/').forward(notification)
+    assert posted == [{key: value for key, value in notification.items() if key != 'received_at'}]
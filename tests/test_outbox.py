@@ -0,0 +1,102 @@
+import pytest
+
+import notifier_core
+from notifier_core import StatusOutbox
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    wakes = []
+    outbox = StatusOutbox(str(tmp_path / 'outbox.sqlite3'), lambda: wakes.append(True))
+    outbox.open()
+    outbox.wakes = wakes
+    yield outbox
+    outbox.close()
+
+
+def test_enqueue_wakes_publisher_and_is_pending(outbox):
+    outbox.enqueue({'notification_id': 1, 'status': 'delivered'})
+    rows = outbox.fetch_pending(10)
+    assert [(row[1], row[2]) for row in rows] == [(1, 'delivered')]
+    assert outbox.wakes == [True]
+    assert outbox.count_pending() == 1
+
+
+def test_repeated_status_is_queued_once(outbox):
+    outbox.enqueue({'notification_id': 1, 'status': 'delivered'})
+    outbox.enqueue({'notification_id': 1, 'status': 'delivered'})
+    outbox.enqueue({'notification_id': 1, 'status': 'read'})
+    assert [(row[1], row[2]) for row in outbox.fetch_pending(10)] == [(1, 'delivered'), (1, 'read')]
+
+
+def test_ids_keep_their_type(outbox):
+    outbox.enqueue({'notification_id': 7, 'status': 'delivered'})
+    outbox.enqueue({'notification_id': '7', 'status': 'delivered'})
+    assert [row[1] for row in outbox.fetch_pending(10)] == [7, '7']
+
+
+def test_confirmation_runs_callbacks_and_marks_sent(outbox):
+    confirmed = []
+    outbox.enqueue({'notification_id': 1, 'status': 'delivered'}, lambda: confirmed.append(1))
+    outbox.enqueue({'notification_id': 2, 'status': 'delivered'}, lambda: confirmed.append(2))
+    rows = outbox.fetch_pending(10)
+    outbox.mark_confirmed(rows[:1])
+    assert confirmed == [1]
+    assert [row[1] for row in outbox.fetch_pending(10)] == [2]
+
+
+def test_status_already_published_confirms_immediately(outbox):
+    outbox.enqueue({'notification_id': 1, 'status': 'delivered'})
+    outbox.mark_confirmed(outbox.fetch_pending(10))
+    confirmed = []
+    outbox.enqueue({'notification_id': 1, 'status': 'delivered'}, lambda: confirmed.append(1))
+    assert confirmed == [1]
+    assert outbox.count_pending() == 0
+
+
+def test_unsent_statuses_survive_reopen(tmp_path):
+    path = str(tmp_path / 'outbox.sqlite3')
+    outbox = StatusOutbox(path, lambda: None)
+    outbox.open()
+    outbox.enqueue({'notification_id': 1, 'status': 'delivered'})
+    outbox.close()
+    reopened = StatusOutbox(path, lambda: None)
+    reopened.open()
+    assert reopened.count_pending() == 1
+    reopened.close()
+
+
+def test_missing_directory_is_created(tmp_path):
+    outbox = StatusOutbox(str(tmp_path / 'missing' / 'outbox.sqlite3'), lambda: None)
+    outbox.open()
+    outbox.enqueue({'notification_id': 1, 'status': 'delivered'})
+    assert outbox.count_pending() == 1
+    outbox.close()
+
+
+def test_statuses_without_id_confirm_only_their_own_callback(outbox):
+    confirmed = []
+    outbox.enqueue({'notification_id': None, 'status': 'delivered'}, lambda: confirmed.append('first'))
+    outbox.enqueue({'notification_id': None, 'status': 'delivered'}, lambda: confirmed.append('second'))
+    rows = outbox.fetch_pending(10)
+    assert len(rows) == 2
+    outbox.mark_confirmed(rows[:1])
+    assert confirmed == ['first']
+    outbox.mark_confirmed(rows[1:])
+    assert confirmed == ['first', 'second']
+
+
+def test_statuses_from_a_previous_run_are_not_latency_samples(tmp_path, monkeypatch):
+    samples = []
+    monkeypatch.setattr(notifier_core.notifier_metrics, 'observe', lambda name, seconds: samples.append(name))
+    path = str(tmp_path / 'outbox.sqlite3')
+    previous = StatusOutbox(path, lambda: None)
+    previous.open()
+    previous.enqueue({'notification_id': 1, 'status': 'delivered'})
+    previous.close()
+    outbox = StatusOutbox(path, lambda: None)
+    outbox.open()
+    outbox.enqueue({'notification_id': 2, 'status': 'delivered'})
+    outbox.mark_confirmed(outbox.fetch_pending(10))
+    assert samples == ['notifier_receipt_to_delivered_seconds']
+    outbox.close()
@@ -0,0 +1,38 @@
+import threading
+
+import notifier_profiling
+
+
+def run_in_new_thread(func):
+    errors = []
+
+    def target():
+        try:
+            func()
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=target)
+    thread.start()
+    thread.join()
+    if errors:
+        raise errors[0]
+
+
+def test_capture_writes_profiles_and_allocations(tmp_path, monkeypatch):
+    monkeypatch.setattr(notifier_profiling, 'PROFILE_DIR', str(tmp_path))
+    targets = {'ui': run_in_new_thread, 'transport': run_in_new_thread}
+    monkeypatch.setattr(notifier_profiling, 'capture_targets', targets)
+    notifier_profiling.start_capture()
+    try:
+        sum(range(1000))
+    finally:
+        notifier_profiling.stop_capture()
+    names = [path.name for path in tmp_path.iterdir()]
+    profiles = [name for name in names if name.endswith('.prof')]
+    if notifier_profiling.PROFILE_PER_THREAD:
+        assert len(profiles) == 2
+    else:
+        assert len(profiles) == 1 and profiles[0].endswith('-all.prof')
+    assert any(name.endswith('-allocations.txt') for name in names)
+    assert notifier_profiling.capture is None
@@ -0,0 +1,67 @@
+from notifier_core import SeenIndex
+
+
+def test_check_and_mark():
+    seen = SeenIndex(None, max_entries=10)
+    assert seen.check_and_mark(1) is False
+    assert seen.check_and_mark(1) is True
+    # Ids are compared as text, as they are stored on disk
+    assert seen.check_and_mark('1') is True
+
+
+def test_least_recently_seen_is_evicted():
+    seen = SeenIndex(None, max_entries=2)
+    seen.check_and_mark(1)
+    seen.check_and_mark(2)
+    seen.check_and_mark(1)
+    seen.check_and_mark(3)
+    assert list(seen.entries) == ['1', '3']
+
+
+def test_persisted_ids_are_loaded(tmp_path):
+    path = str(tmp_path / 'seen.txt')
+    seen = SeenIndex(path, max_entries=10)
+    for notification_id in (1, 2):
+        seen.check_and_mark(notification_id)
+        seen.persist(notification_id)
+    loaded = SeenIndex(path, max_entries=10)
+    loaded.load()
+    assert loaded.check_and_mark(1) is True
+    assert loaded.check_and_mark(3) is False
+
+
+def test_load_keeps_newest_ids(tmp_path):
+    path = tmp_path / 'seen.txt'
+    path.write_text(''.join(f'{n}\n' for n in range(10)))
+    seen = SeenIndex(str(path), max_entries=3)
+    seen.load()
+    assert list(seen.entries) == ['7', '8', '9']
+
+
+def test_file_is_compacted(tmp_path):
+    path = tmp_path / 'seen.txt'
+    seen = SeenIndex(str(path), max_entries=2)
+    for notification_id in range(6):
+        seen.check_and_mark(notification_id)
+        seen.persist(notification_id)
+    assert len(path.read_text().splitlines()) <= 4
+    loaded = SeenIndex(str(path), max_entries=2)
+    loaded.load()
+    assert list(loaded.entries) == ['4', '5']
+
+
+def test_compaction_keeps_only_confirmed_ids(tmp_path):
+    path = tmp_path / 'seen.txt'
+    seen = SeenIndex(str(path), max_entries=3)
+    for notification_id in range(6):
+        seen.check_and_mark(notification_id)
+        seen.persist(notification_id)
+    # Received, but 'delivered' not confirmed yet: must not reach the file, or a crash would drop its redelivery
+    seen.check_and_mark('unconfirmed')
+    seen.check_and_mark(6)
+    seen.persist(6)
+    assert 'unconfirmed' not in path.read_text().split()
+    loaded = SeenIndex(str(path), max_entries=3)
+    loaded.load()
+    assert loaded.check_and_mark('unconfirmed') is False
+    assert loaded.check_and_mark(6) is True
@@ -0,0 +1,64 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app')
+
+
+@pytest.fixture
+def silent_backend():
+    """ A backend that accepts connections and never answers; yields (port, event set on the first request). """
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(16)
+    accepted = threading.Event()
+    connections = []
+
+    def accept():
+        while True:
+            try:
+                connection, _ = server.accept()
+            except OSError:
+                return
+            connections.append(connection)
+            accepted.set()
+
+    threading.Thread(target=accept, daemon=True).start()
+    yield server.getsockname()[1], accepted
+    server.close()
+    for connection in connections:
+        connection.close()
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason="uses SIGTERM")
+def test_headless_exit_is_bounded_by_deadline(tmp_path, silent_backend):
+    pytest.importorskip('pika')
+    pytest.importorskip('requests')
+    port, accepted = silent_backend
+    with socket.socket() as unused:
+        unused.bind(('127.0.0.1', 0))
+        broker_port = unused.getsockname()[1]
+    env = dict(os.environ, API_BASE_URL=f'http://127.0.0.1:{port}', RABBITMQ_HOST='127.0.0.1',
+               RABBITMQ_PORT=str(broker_port), TOKEN_FILE_PATH=str(tmp_path / 'token.json'),
+               SHUTDOWN_DEADLINE_SECONDS='2', HTTP_READ_TIMEOUT='30', PYTHONUNBUFFERED='1')
+    process = subprocess.Popen([sys.executable, os.path.join(APP_DIR, 'notifier_core.py')], env=env, cwd=tmp_path,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    try:
+        # No token, so the client pairs first; wait until that request is stuck on the backend
+        assert accepted.wait(20), "the client never contacted the backend"
+        time.sleep(0.5)
+        started = time.monotonic()
+        process.send_signal(signal.SIGTERM)
+        process.wait(15)
+        elapsed = time.monotonic() - started
+    finally:
+        process.kill()
+        output = process.stdout.read()
+    assert elapsed < 3, output
+    assert process.returncode == 0, output
@@ -0,0 +1,122 @@
+import asyncio
+import types
+
+import pytest
+
+import notifier_core
+from notifier_core import ReconnectSupervisor, notification_channel, parse_time, expiry_time, parse_attachments
+
+
+def test_backoff_stays_within_bounds():
+    supervisor = types.SimpleNamespace(delay=notifier_core.RECONNECT_BASE_SECONDS)
+    delays = [ReconnectSupervisor.next_delay(supervisor) for _ in range(200)]
+    assert all(notifier_core.RECONNECT_BASE_SECONDS <= delay <= notifier_core.RECONNECT_CAP_SECONDS
+               for delay in delays)
+    assert max(delays) == notifier_core.RECONNECT_CAP_SECONDS
+
+
+def test_parse_time():
+    assert parse_time(1700000000) == 1700000000.0
+    assert parse_time('2023-11-14T22:13:20+00:00') == 1700000000.0
+    assert parse_time('2023-11-14T22:13:20.000Z') == 1700000000.0
+    assert parse_time(True) is None
+    assert parse_time('garbage') is None
+    assert parse_time(None) is None
+
+
+def test_expiry_time():
+    properties = types.SimpleNamespace(expiration='60000')
+    assert expiry_time({'expires_at': 100}, properties, 10) == 100
+    assert expiry_time({}, properties, 10) == 70
+    assert expiry_time({}, types.SimpleNamespace(expiration=None), 10) is None
+    assert expiry_time({}, types.SimpleNamespace(expiration='soon'), 10) is None
+
+
+def test_notification_channel():
+    def method(exchange, routing_key='abc'):
+        return types.SimpleNamespace(exchange=exchange, routing_key=routing_key)
+
+    assert notification_channel(method('notifications')) == 'direct'
+    assert notification_channel(method(notifier_core.BROADCAST_EXCHANGE)) == 'broadcast'
+    assert notification_channel(method(notifier_core.GROUP_EXCHANGE, 'line.3')) == 'group:line.3'
+
+
+def test_parse_attachments():
+    attachments = parse_attachments({'attachments': [
+        {'path': '/attachments/1/', 'name': 'plan.pdf', 'size': 10},
+        {'path': 'http://elsewhere/x'},
+        'not an attachment',
+        {'path': '/attachments/2/'},
+    ]})
+    assert [(a['path'], a['name']) for a in attachments] == [('/attachments/1/', 'plan.pdf'), ('/attachments/2/', '2')]
+
+
+def make_supervisor():
+    core = types.SimpleNamespace(update_status=lambda text: None)
+    supervisor = ReconnectSupervisor.__new__(ReconnectSupervisor)
+    supervisor.core = core
+    supervisor.state = None
+    supervisor.listening = types.SimpleNamespace(set=lambda: None, clear=lambda: None)
+    return supervisor
+
+
+def test_declaration_conflict_does_not_repair():
+    pika = pytest.importorskip('pika')
+    notifier_core.load_transport_modules()
+    supervisor = make_supervisor()
+    supervisor.on_session_lost(pika.exceptions.ChannelClosedByBroker(406, 'PRECONDITION_FAILED'))
+    assert (supervisor.state, supervisor.retry_state) == (ReconnectSupervisor.BACKOFF, ReconnectSupervisor.CONNECTING)
+
+
+def test_refused_channel_repairs():
+    pika = pytest.importorskip('pika')
+    notifier_core.load_transport_modules()
+    supervisor = make_supervisor()
+    supervisor.on_session_lost(pika.exceptions.ChannelClosedByBroker(404, 'NOT_FOUND'), healthy=True)
+    assert supervisor.state == ReconnectSupervisor.REPAIRING
+
+
+def test_repeatedly_refused_channel_backs_off_before_repairing():
+    pika = pytest.importorskip('pika')
+    notifier_core.load_transport_modules()
+    supervisor = make_supervisor()
+    # Refused on connect, i.e. the session never got to consume
+    supervisor.on_session_lost(pika.exceptions.ChannelClosedByBroker(403, 'ACCESS_REFUSED'))
+    assert (supervisor.state, supervisor.retry_state) == (ReconnectSupervisor.BACKOFF, ReconnectSupervisor.REPAIRING)
+
+
+def test_refused_presence_sends_rest_heartbeat_at_once():
+    pika = pytest.importorskip('pika')
+    notifier_core.load_transport_modules()
+    heartbeats = []
+
+    async def confirm_nack():
+        core = types.SimpleNamespace(loop=asyncio.get_running_loop(), send_heartbeat=lambda: heartbeats.append(1),
+                                     outbox_wakeup=asyncio.Event())
+        session = notifier_core.AmqpSession(core)
+        session.in_flight[1] = []
+        session.presence_tags[1] = 0
+        frame = types.SimpleNamespace(method=pika.spec.Basic.Nack(delivery_tag=1))
+        session.on_delivery_confirmation(frame)
+        await asyncio.sleep(0.1)
+        return session.presence_accepted
+
+    assert asyncio.run(confirm_nack()) is False
+    assert heartbeats == [1]
+
+
+def test_plain_queue_declaration_keeps_existing_queue(monkeypatch, capsys):
+    monkeypatch.setattr(notifier_core, 'CONSUMER_MAX_PRIORITY', 0)
+    declared = []
+
+    async def refuse(method_name, **kwargs):
+        declared.append((method_name, kwargs))
+        return False
+
+    session = notifier_core.AmqpSession.__new__(notifier_core.AmqpSession)
+    session.core = types.SimpleNamespace(queue_arguments_reported=False)
+    session.declare_separately = refuse
+    asyncio.run(session.declare_consumer_queue('queue_abc'))
+    # Declared on a throwaway channel, so a queue with x-max-priority doesn't close the consumer channel
+    assert declared == [('queue_declare', {'queue': 'queue_abc', 'durable': True, 'arguments': None})]
+    assert 'no x-max-priority' in capsys.readouterr().out